@@ -1,6 +1,9 @@
 import os
 import rasterio
 import json
+import time
+import numpy as np
+from rasterio.enums import Resampling
 from Sagebrush.stsim_utils import stsim_manager
 from OutputProcessing import texture_utils, raster_utils
 from math import ceil
@@ -11,6 +14,9 @@ TIFF_SIZE = 512
 TEXTURE_SIZE_RATIO = 0.5    # texture size = tiff_size * ratio
 TIFF_STRIDE = 2
 
+OPTIMIZED_BLOCK_SIZE = 256
+MIN_OVERVIEW_SIZE = 256     # stop building overviews once the smallest side is below this
+
 
 # Print iterations progress
 def print_progress(iteration, total, prefix='', suffix='', decimals=1, bar_length=50):
@@ -57,6 +63,14 @@ def build_reporting_units(name, lib, layer, output_dir=None, one_shot=False, sin
     veg_path = stsim_manager.veg_paths[lib]
     sc_path = stsim_manager.sc_paths[lib]
     elev_path = stsim_manager.elev_paths[lib]
+
+    # clip from the library-wide converted stateclass raster when it has been built
+    convert_tiles = len(stsim_manager.conversion_functions[lib]) > 0
+    converted_sc_path = conversions.converted_stateclass_path(lib) if convert_tiles else None
+    if converted_sc_path is not None:
+        sc_path = converted_sc_path
+        convert_tiles = False
+
     reporting_units = parse_reporting_units(layer)
     output_dir = os.path.join(output_dir, lib, name)
 
@@ -171,31 +185,27 @@ def build_reporting_units(name, lib, layer, output_dir=None, one_shot=False, sin
                         'nodata': 0
                     })
 
-                    # output vegetation rasters
+                    # output stateclass rasters
                     output_path = os.path.join(unit_dir, 'sc', '-'.join([str(i), str(j), 'sc.tif']))
                     temp_veg_path = output_path.replace('sc', 'veg')
+                    sc_data = src.read(1, window=window)[::TIFF_STRIDE, ::TIFF_STRIDE].astype('int32')
+                    with rasterio.open(temp_veg_path, 'r') as veg_src:
+                        veg_data = veg_src.read(1)
 
-                    if len(stsim_manager.conversion_functions[lib]) > 0:
-                        temp_sc_path = output_path.replace('sc', 'temp')
-                        with rasterio.open(temp_sc_path, 'w', **out_kwargs) as dst:
-                            dst.write(src.read(1, window=window)[::TIFF_STRIDE,::TIFF_STRIDE].astype('int32'), 1)
-                        sc_conversion_func = getattr(conversions, stsim_manager.conversion_functions[lib])
-                        sc_conversion_func(temp_veg_path, temp_sc_path, output_path)
-                        os.remove(temp_sc_path)
-                    else:
-                        with rasterio.open(output_path, 'w', **out_kwargs) as dst:
-                            dst.write(src.read(1, window=window)[::TIFF_STRIDE,::TIFF_STRIDE].astype('int32'), 1)
+                    if convert_tiles:
+                        sc_data = conversions.convert_arrays(stsim_manager.conversion_functions[lib], veg_data, sc_data)
 
-                    sc_texture = texture_utils.stateclass_texture(output_path, sc_colormap)
+                    sc_texture = texture_utils.stateclass_array_texture(sc_data, sc_colormap)
                     sc_texture.save(output_path.replace('tif', 'png'))
 
                     # collect zonal stats for this chunk
-                    row_stats.append(raster_utils.zonal_stateclass_stats(temp_veg_path, output_path, sc_defs))
+                    row_stats.append(raster_utils.zonal_stateclass_array_stats(veg_data, sc_data, sc_defs))
 
-                    if not save_tifs:
-                        # Remove the tifs after the conversion process is done.
-                        os.remove(output_path)
-                        os.remove(output_path.replace('sc', 'veg'))
+                    if save_tifs:
+                        raster_utils.write_raster(output_path, sc_data, out_kwargs)
+                    else:
+                        # Remove the vegetation tif after the conversion process is done.
+                        os.remove(temp_veg_path)
 
                 raw_unit_zonal_stats.append(row_stats)
 
@@ -274,6 +284,32 @@ def build_reporting_units(name, lib, layer, output_dir=None, one_shot=False, sin
             break
 
 
+def build_converted_stateclass(lib, processes=None):
+    """
+    Converts the stateclass raster of the whole library extent, for selections and tile builds to clip from.
+    :param lib: Name of the library in the STSIM_CONFIG
+    :param processes: Number of processes to convert blocks with, defaults to STSIM_CONVERSION_PROCESSES
+    :return: Path to the converted raster
+    """
+
+    if lib not in stsim_manager.library_names:
+        raise KeyError('{lib} is not an available library.'.format(lib=lib))
+
+    output_path = stsim_manager.converted_sc_paths[lib]
+    if output_path is None:
+        raise KeyError('{lib} has no conversion function.'.format(lib=lib))
+
+    fingerprint = conversions.conversion_fingerprint(lib)
+    temp_path = output_path + '.tmp'
+    conversions.convert_raster(stsim_manager.conversion_functions[lib], stsim_manager.veg_paths[lib],
+                               stsim_manager.sc_paths[lib], temp_path, processes)
+    os.replace(temp_path, output_path)
+    with open(output_path + '.json', 'w') as f:
+        json.dump(fingerprint, f)
+    conversions.forget_converted_stateclass(lib)
+    return output_path
+
+
 def parse_reporting_units(path):
 
     extents = list()
@@ -339,3 +375,119 @@ def total_elevation_stats(raw_stats):
             max_height = col['dem_max'] if col['dem_max'] > max_height else max_height
 
     return {'dem_min': min_height, 'dem_max': max_height, 'dem_width': width, 'dem_height': height}
+
+
+def optimize_source_rasters(lib, layer=None, sample_size=10, replace=False):
+    """
+    Rewrites the source rasters of a library with internal tiling, lossless compression and overviews.
+    Categorical rasters (veg, sc) use deflate and mode overviews, the elevation uses deflate with
+    horizontal differencing and average overviews. Each result is checked against its source before
+    it is used.
+    :param lib: Name of the library in the STSIM_CONFIG
+    :param layer: Path to a reporting unit layer, used to sample read latency before and after
+    :param sample_size: Number of reporting unit windows to time
+    :param replace: Replace the source rasters, keeping the originals with a .bak extension.
+        Otherwise the optimized rasters are written next to them with a .optimized.tif extension.
+    :return: A dict of read latencies, in seconds, by raster type
+    """
+
+    if lib not in stsim_manager.library_names:
+        raise KeyError('{lib} is not an available library.'.format(lib=lib))
+
+    if stsim_manager.has_predefined_extent[lib]:
+        raise KeyError("{lib} has a predefined extent, its rasters aren't clipped. Exiting...".format(lib=lib))
+
+    windows = parse_reporting_units(layer)[:sample_size] if layer is not None else list()
+    rasters = [('veg', stsim_manager.veg_paths[lib], True),
+               ('sc', stsim_manager.sc_paths[lib], True),
+               ('elev', stsim_manager.elev_paths[lib], False)]
+
+    report = dict()
+    for raster_type, path, categorical in rasters:
+        optimized_path = os.path.splitext(path)[0] + '.optimized.tif'
+        print('Optimizing {path}...'.format(path=path))
+        write_optimized_raster(path, optimized_path, categorical)
+        validate_optimized_raster(path, optimized_path)
+
+        before = sample_read_latency(path, windows)
+        after = sample_read_latency(optimized_path, windows)
+        report[raster_type] = {'before': before, 'after': after}
+        if len(windows) > 0:
+            print('{type}: mean read {before:.4f}s -> {after:.4f}s over {count} reporting units'.format(
+                type=raster_type, before=before, after=after, count=len(windows)))
+
+        if replace:
+            os.replace(path, path + '.bak')
+            os.replace(optimized_path, path)
+
+    return report
+
+
+def write_optimized_raster(input_path, output_path, categorical):
+    """ Copy a raster block by block into a tiled, compressed GeoTIFF and build its overview pyramid. """
+
+    with rasterio.open(input_path, 'r') as src:
+        out_kwargs = src.meta.copy()
+        out_kwargs.update({
+            'driver': 'GTiff',
+            'tiled': True,
+            'blockxsize': OPTIMIZED_BLOCK_SIZE,
+            'blockysize': OPTIMIZED_BLOCK_SIZE,
+            'compress': 'deflate',
+            'predictor': 1 if categorical else 2,   # differencing only helps continuous data
+            'bigtiff': 'IF_SAFER'
+        })
+
+        with rasterio.open(output_path, 'w', **out_kwargs) as dst:
+            windows = [window for index, window in dst.block_windows(1)]
+            p = 0
+            print_progress(p, len(windows), prefix='Progress:', suffix='Complete')
+            for window in windows:
+                dst.write(src.read(window=window), window=window)
+                p += 1
+                if p % 100 == 0 or p == len(windows):
+                    print_progress(p, len(windows), prefix='Progress:', suffix='Complete')
+
+            factors = list()
+            factor = 2
+            while min(src.height, src.width) / factor >= MIN_OVERVIEW_SIZE:
+                factors.append(factor)
+                factor *= 2
+            if len(factors) > 0:
+                resampling = Resampling.mode if categorical else Resampling.average
+                dst.build_overviews(factors, resampling)
+                dst.update_tags(ns='rio_overview', resampling=resampling.name)
+
+
+def validate_optimized_raster(input_path, output_path):
+    """ Make sure an optimized raster is tiled, has overviews and holds the same data as its source. """
+
+    with rasterio.open(input_path, 'r') as src, rasterio.open(output_path, 'r') as dst:
+        if (src.width, src.height, src.count) != (dst.width, dst.height, dst.count) or src.crs != dst.crs:
+            raise ValueError('{path} does not match the shape or projection of its source.'.format(path=output_path))
+
+        if dst.block_shapes[0] != (OPTIMIZED_BLOCK_SIZE, OPTIMIZED_BLOCK_SIZE):
+            raise ValueError('{path} is not tiled.'.format(path=output_path))
+
+        if min(dst.height, dst.width) >= MIN_OVERVIEW_SIZE * 2 and len(dst.overviews(1)) == 0:
+            raise ValueError('{path} has no overviews.'.format(path=output_path))
+
+        for index, window in dst.block_windows(1):
+            if not np.array_equal(src.read(window=window), dst.read(window=window)):
+                raise ValueError('{path} differs from its source in window {window}.'.format(path=output_path,
+                                                                                             window=window))
+
+
+def sample_read_latency(path, windows):
+    """ Mean time, in seconds, to read a set of reporting unit extents from a raster. """
+
+    if len(windows) == 0:
+        return 0
+
+    elapsed = 0
+    with rasterio.open(path, 'r') as src:
+        for unit in windows:
+            start = time.time()
+            src.read(1, window=src.window(*unit['extent']))
+            elapsed += time.time() - start
+    return elapsed / len(windows)
@@ -1,8 +1,18 @@
+import os
+import sys
+import json
+import inspect
+import hashlib
 import rasterio
 import csv
 import numpy as np
+from multiprocessing import Pool
+from django.conf import settings
 from Sagebrush.stsim_utils import stsim_manager
 
+# Number of processes to convert whole rasters with
+CONVERSION_PROCESSES = getattr(settings, 'STSIM_CONVERSION_PROCESSES', os.cpu_count())
+
 # cover types for LANDFIRE
 cover_string = ['Early Development ', 'Mid Development ', 'Late Development ']
 cover_types = list()
@@ -69,37 +79,208 @@ def convert_misc_info(misc_code):
     return misc_code
 
 
-def landfire_stateclass_index_raster(bps_path, sc_path, output_path):
+def compile_landfire_lookup():
+    """
+    Compiles the BpS x succession class mapping into dense lookup arrays.
+    :return: (bps_codes, sclass_lookup) where bps_codes is the sorted array of known BpS codes and
+        sclass_lookup[row, sc_code] the stateclass index for bps_codes[row]
+    """
+    bps_codes = np.array(sorted(sc_code_map.keys()), dtype='int64')
+    sclass_lookup = np.zeros((bps_codes.size, max(valid_sclass_codes) + 1), dtype='int32')
+    for row, bps_code in enumerate(bps_codes):
+        for sc_code in valid_sclass_codes:
+            state_class_type = sc_code_map[int(bps_code)][sc_code]
+            if len(state_class_type) > 0:
+                sclass_lookup[row, sc_code] = sclass_index[state_class_type]
+    return bps_codes, sclass_lookup
+
+
+valid_sclass_lookup = np.zeros(max(valid_sclass_codes) + 1, dtype='bool')
+valid_sclass_lookup[valid_sclass_codes] = True
+
+misc_lookup = np.zeros(max(valid_misc_codes) + 1, dtype='int32')
+for code in valid_misc_codes:
+    misc_lookup[code] = convert_misc_info(code)
+
+if 'Landfire' in stsim_manager.library_names:
+    landfire_bps_codes, landfire_sclass_lookup = compile_landfire_lookup()
+
+
+def landfire_stateclass_index(bps_data, sc_data):
+    """
+        Convert LANDFIRE BpS and Succession-Class arrays into index stateclass data useable in SyncroSim.
+        :param bps_data Array of Biophysical settings codes
+        :param sc_data Array of Succession Class codes, the same shape as bps_data
+        :return The indexed succession class array, with the dtype of sc_data
+    """
+
+    # bps codes look like 910080 for zone 9, model 10080
+    # sc codes look like 1 - 5 plus other stuff which we can use for modeling water, urban, agriculture
+    # resulting codes will match from 1 to 27, which we will use in syncrosim project definitions
+    bps_ravel = bps_data.ravel().astype('int64')
+    sc_ravel = sc_data.ravel().astype('int64')
+    mapped_data = np.zeros(sc_ravel.size, dtype=sc_data.dtype)
+
+    # succession classes of known, non-zero BpS codes
+    is_sclass = np.zeros(sc_ravel.size, dtype='bool')
+    in_range = (sc_ravel >= 0) & (sc_ravel < valid_sclass_lookup.size)
+    is_sclass[in_range] = valid_sclass_lookup[sc_ravel[in_range]]
+    if landfire_bps_codes.size > 0:
+        rows = np.clip(np.searchsorted(landfire_bps_codes, bps_ravel), 0, landfire_bps_codes.size - 1)
+        known = is_sclass & (bps_ravel != 0) & (landfire_bps_codes[rows] == bps_ravel)
+        mapped_data[known] = landfire_sclass_lookup[rows[known], sc_ravel[known]]
+
+    # everything else we can use for modeling water, urban, agriculture
+    is_misc = ~is_sclass & (sc_ravel >= 0) & (sc_ravel < misc_lookup.size)
+    mapped_data[is_misc] = misc_lookup[sc_ravel[is_misc]]
+
+    return np.reshape(mapped_data, sc_data.shape)
+
+
+def landfire_stateclass_index_raster(bps_path, sc_path, output_path, processes=None):
     """
         Convert LANDFIRE BpS and Succession-Class data into index stateclass data useable in SyncroSim.
         :param bps_path Path to Biophysical settings file
         :param sc_path Path to Succession Class settings file
         :param output_path Path to create the indexed succession class settings file
+        :param processes Number of processes to convert blocks with, defaults to STSIM_CONVERSION_PROCESSES
     """
 
-    # bps codes look like 910080 for zone 9, model 10080
-    # sc codes look like 1 - 5 plus other stuff which we can use for modeling water, urban, agriculture
-    # resulting codes will match from 1 to 27, which we will use in syncrosim project definitions
-    with rasterio.open(bps_path, 'r') as bps_src:
-        windows = [window for index, window in bps_src.block_windows(1)]
-        with rasterio.open(sc_path, 'r') as sc_src:
-            with rasterio.open(output_path, 'w', **sc_src.profile) as dst:
+    convert_blocks(landfire_stateclass_index, bps_path, sc_path, output_path, processes)
+
+
+# In-memory counterparts of the raster conversion functions named in the configuration
+array_conversions = {
+    'landfire_stateclass_index_raster': landfire_stateclass_index
+}
+
+
+def convert_arrays(function_name, veg_data, sc_data):
+    """
+    Run a configured conversion function on arrays instead of rasters.
+    :param function_name: The conversion function named in the STSIM_CONFIG
+    :param veg_data: Array of vegetation codes
+    :param sc_data: Array of stateclass codes, the same shape as veg_data
+    :return: The converted stateclass array
+    """
+    return array_conversions[function_name](veg_data, sc_data)
+
+
+def convert_raster(function_name, veg_path, sc_path, output_path, processes=None):
+    """
+    Run a configured conversion function over whole rasters, block by block.
+    :param function_name: The conversion function named in the STSIM_CONFIG
+    :param veg_path: Path to the vegetation raster
+    :param sc_path: Path to the stateclass raster
+    :param output_path: Path to create the converted stateclass raster
+    :param processes: Number of processes to convert blocks with, defaults to STSIM_CONVERSION_PROCESSES
+    """
+    convert_blocks(array_conversions[function_name], veg_path, sc_path, output_path, processes)
+
+
+# Open datasets of the conversion running in this worker process
+_block_sources = dict()
+
+
+def _open_block_sources(array_function, veg_path, sc_path):
+    _block_sources['function'] = array_function
+    _block_sources['veg'] = rasterio.open(veg_path, 'r')
+    _block_sources['sc'] = rasterio.open(sc_path, 'r')
+
+
+def _convert_block(window):
+    veg_data = _block_sources['veg'].read(1, window=window)
+    sc_data = _block_sources['sc'].read(1, window=window)
+    return window, _block_sources['function'](veg_data, sc_data)
+
+
+def convert_blocks(array_function, veg_path, sc_path, output_path, processes=None):
+    """
+    Converts rasters block by block, fanning the blocks out over a pool of processes.
+    Each worker opens the inputs itself and converts the blocks it's handed; results are written
+    back in block order by this process.
+    :param array_function: Function converting a (veg_data, sc_data) pair of arrays
+    :param veg_path: Path to the vegetation raster
+    :param sc_path: Path to the stateclass raster
+    :param output_path: Path to create the converted stateclass raster
+    :param processes: Number of processes to convert blocks with, defaults to STSIM_CONVERSION_PROCESSES
+    """
+
+    processes = processes or CONVERSION_PROCESSES or 1
+    with rasterio.open(veg_path, 'r') as veg_src:
+        windows = [window for index, window in veg_src.block_windows(1)]
+    with rasterio.open(sc_path, 'r') as sc_src:
+        profile = sc_src.profile
+
+    with rasterio.open(output_path, 'w', **profile) as dst:
+        if processes <= 1:
+            _open_block_sources(array_function, veg_path, sc_path)
+            try:
                 for window in windows:
-                    bps_data = bps_src.read(1, window=window)
-                    bps_ravel = bps_data.ravel()
-                    sc_data = sc_src.read(1, window=window)
-                    shape = sc_data.shape
-                    sc_ravel = sc_data.ravel()
-                    mapped_data = np.zeros(shape[0] * shape[1], dtype=sc_data.dtype)
-                    for pixel in range(mapped_data.size):
-                        bps_code = bps_ravel[pixel]
-                        sc_code = sc_ravel[pixel]
-                        if sc_code in valid_sclass_codes and bps_code != 0 and bps_code in sc_code_map.keys():
-                            state_class_type = sc_code_map[bps_code][sc_code]
-                            if len(state_class_type) > 0:
-                                state_class_value = sclass_index[state_class_type]
-                                mapped_data[pixel] = state_class_value
-                        elif sc_code in valid_misc_codes:
-                            mapped_data[pixel] = convert_misc_info(sc_code)
-                    output_data = np.reshape(mapped_data, shape)
-                    dst.write(output_data, indexes=1, window=window)
+                    dst.write(_convert_block(window)[1], indexes=1, window=window)
+            finally:
+                _block_sources.pop('veg').close()
+                _block_sources.pop('sc').close()
+        else:
+            chunksize = max(1, len(windows) // (processes * 16))
+            with Pool(processes, initializer=_open_block_sources,
+                      initargs=(array_function, veg_path, sc_path)) as pool:
+                for window, data in pool.imap(_convert_block, windows, chunksize):
+                    dst.write(data, indexes=1, window=window)
+
+
+def conversion_fingerprint(lib):
+    """
+    Identifies everything a converted stateclass raster depends on: the conversion code, the
+    descriptions it's compiled from and the source rasters.
+    :param lib: Name of the library in the STSIM_CONFIG
+    """
+    function_name = stsim_manager.conversion_functions[lib]
+    module_source = inspect.getsource(sys.modules[array_conversions[function_name].__module__])
+    with open(stsim_manager.desc_file_path[lib], 'rb') as f:
+        descriptions = hashlib.sha1(f.read()).hexdigest()
+
+    def stamp(path):
+        stat = os.stat(path)
+        return [stat.st_size, stat.st_mtime]
+
+    return {'function': function_name,
+            'function_source': hashlib.sha1(module_source.encode('utf-8')).hexdigest(),
+            'descriptions': descriptions,
+            'veg': stamp(stsim_manager.veg_paths[lib]),
+            'sc': stamp(stsim_manager.sc_paths[lib])}
+
+
+# validated converted raster path by library, along with the file stamps it was validated against
+_converted_stateclass = dict()
+
+
+def converted_stateclass_path(lib):
+    """
+    Path to the library-wide converted stateclass raster, if it has been built and is still current.
+    :param lib: Name of the library in the STSIM_CONFIG
+    :return: The path, or None if the raster has to be converted on the fly.
+    """
+    output_path = stsim_manager.converted_sc_paths.get(lib)
+    if output_path is None:
+        return None
+
+    paths = [output_path, output_path + '.json', stsim_manager.desc_file_path[lib],
+             stsim_manager.veg_paths[lib], stsim_manager.sc_paths[lib], __file__]
+    try:
+        stamps = [(os.path.getmtime(path), os.path.getsize(path)) for path in paths]
+    except OSError:
+        return None     # not built yet
+
+    if lib in _converted_stateclass and _converted_stateclass[lib][0] == stamps:
+        return _converted_stateclass[lib][1]
+
+    with open(output_path + '.json', 'r') as f:
+        current = json.load(f) == json.loads(json.dumps(conversion_fingerprint(lib)))
+    _converted_stateclass[lib] = (stamps, output_path if current else None)
+    return _converted_stateclass[lib][1]
+
+
+def forget_converted_stateclass(lib):
+    """ Drops the validation memo for a library, e.g. after its converted raster was rebuilt. """
+    _converted_stateclass.pop(lib, None)
@@ -5,33 +5,106 @@
     setup, we can define the name of the function in the overall configuration
     file, supply the fieldname, and then, in the LookupView, pass back the mapped
     values to the application for consumption.
+
+    Tables are loaded once into a dictionary keyed by code and re-read when the
+    file changes on disk, so a lookup only costs as much as the codes it asks for.
 """
 
+import os
 import csv
+import threading
 from Sagebrush.stsim_utils import stsim_manager
 
 
-def landfire_lookup(bps_codes, fieldname):
+class LookupTable:
     """
-    Plugin for the Landfire lookup table
-    :param bps_codes: A list of Biophysical settings that we want to return
-    :param fieldname: The fieldname to lookup
-    :return:
+        A lookup CSV indexed by normalized code.
     """
 
-    result = dict()
+    def __init__(self, path, code_field, normalize):
+        """
+        :param path: Path to the CSV file
+        :param code_field: Name of the column holding the codes
+        :param normalize: Function turning a raw code into (key, display_code), raising ValueError for rows to skip
+        """
+        self.path = path
+        self.code_field = code_field
+        self.normalize = normalize
+        self.mtime = None
+        self.rows = dict()
+        self.lock = threading.Lock()
 
-    with open(stsim_manager.lookup_file_path['Landfire'], 'r') as f:
+    def refresh(self):
+        """ (Re)load the table if the file changed since it was last read. """
+        mtime = os.path.getmtime(self.path)
+        if mtime == self.mtime:
+            return
+        with self.lock:
+            if mtime == self.mtime:
+                return
+            rows = dict()
+            with open(self.path, 'r') as f:
+                for table_row in csv.DictReader(f):
+                    try:
+                        key, display_code = self.normalize(table_row[self.code_field])
+                    except (ValueError, TypeError):
+                        continue    # skip all the non-int parseable entries
+                    rows[key] = (display_code, table_row)
+            self.rows = rows
+            self.mtime = mtime
 
-        lookup = csv.DictReader(f)
-        for table_row in lookup:
-            read_bps_code = table_row['BPS_MODEL']
-            read_bps_code = '0' + read_bps_code if len(read_bps_code) < 7 else read_bps_code
+    def lookup(self, codes, fieldnames):
+        """
+        Look up one or more fields for a batch of codes.
+        :param codes: The codes to look up
+        :param fieldnames: A fieldname, or a list of fieldnames
+        :return: {code: value} for a single fieldname, {code: {fieldname: value}} for a list of them
+        """
+        self.refresh()
+        rows = self.rows
+        result = dict()
+        for code in codes:
             try:
-                if int(read_bps_code) in [int(code) for code in bps_codes]:
-                    value = table_row[fieldname]
-                    result[read_bps_code] = value
-            except:
-                continue    # skip all the non-int parseable entries
-
+                key = self.normalize(code)[0]
+            except (ValueError, TypeError):
+                continue
+            if key not in rows:
+                continue
+            display_code, table_row = rows[key]
+            if isinstance(fieldnames, str):
+                if fieldnames in table_row:
+                    result[display_code] = table_row[fieldnames]
+            else:
+                result[display_code] = {fieldname: table_row[fieldname]
+                                        for fieldname in fieldnames if fieldname in table_row}
         return result
+
+
+_tables = dict()
+_tables_lock = threading.Lock()
+
+
+def lookup_table(path, code_field, normalize):
+    """ The shared table for a lookup file, created on first use. """
+    with _tables_lock:
+        if path not in _tables:
+            _tables[path] = LookupTable(path, code_field, normalize)
+        return _tables[path]
+
+
+def normalize_bps_code(code):
+    code = str(code)
+    code = '0' + code if len(code) < 7 else code
+    return int(code), code
+
+
+def landfire_lookup(bps_codes, fieldname):
+    """
+    Plugin for the Landfire lookup table
+    :param bps_codes: A list of Biophysical settings that we want to return
+    :param fieldname: The fieldname to lookup, or a list of fieldnames
+    :return:
+    """
+
+    table = lookup_table(stsim_manager.lookup_file_path['Landfire'], 'BPS_MODEL', normalize_bps_code)
+    return table.lookup(bps_codes, fieldname)
@@ -1,96 +1,192 @@
 # raster_utils
 
 import rasterio
+from math import ceil, sqrt
+from affine import Affine
 from rasterio.warp import transform_bounds
 from rasterio.crs import CRS
 import numpy as np
 
 
-def clip_from_wgs(input_path, output_path, bounds):
+def snapped_window(src, bounds):
     """
-        Clips a raster based on WGS coordinates.
+        The window of an open raster covered by WGS coordinates, snapped to its pixel grid.
+    """
+
+    wgs_crs = CRS({'init': 'epsg:4326'})  # WGS 84 Projection
+    window = src.window(*transform_bounds(wgs_crs, src.crs, *bounds))
+    return tuple(tuple(int(round(index)) for index in axis) for axis in window)
+
+
+def wgs_window(input_path, bounds):
+    """
+        The window of a raster covered by WGS coordinates, snapped to the raster's pixel grid.
+        :param input_path The path to the raster
+        :param bounds (left, bottom, right, top) bounds in WGS 84 projection
+        :return ((row_start, row_stop), (col_start, col_stop))
+    """
+
+    with rasterio.open(input_path, 'r') as src:
+        return snapped_window(src, bounds)
+
+
+def decimated_shape(window, max_size):
+    """
+        The shape to read a window at so that neither side exceeds max_size pixels.
+        :param window ((row_start, row_stop), (col_start, col_stop))
+        :param max_size Maximum number of pixels on either side
+        :return (height, width) of the decimated read
+    """
+
+    height = window[0][1] - window[0][0]
+    width = window[1][1] - window[1][0]
+    factor = max(1, int(ceil(max(height, width) / max_size)))
+    return int(ceil(height / factor)), int(ceil(width / factor))
+
+
+def cell_scale(window, max_size):
+    """
+        Length of a side of a decimated cell, in source cells.
+        :param window ((row_start, row_stop), (col_start, col_stop))
+        :param max_size Maximum number of pixels on either side
+    """
+
+    height = window[0][1] - window[0][0]
+    width = window[1][1] - window[1][0]
+    out_height, out_width = decimated_shape(window, max_size)
+    if out_height * out_width == 0:
+        return 1.0
+    return sqrt((height * width) / (out_height * out_width))
+
+
+def read_clip(input_path, bounds, max_size=2048):
+    """
+        Reads the part of a raster within WGS coordinates into memory.
+        Selections larger than max_size pixels on a side are read decimated, so that the whole
+        extent fits; GDAL will use the raster's overviews for this where it has them.
         Heavily borrowed from: https://github.com/mapbox/rasterio/blob/master/rasterio/rio/clip.py
         :param input_path The path to the raster to clip out of
-        :param output_path The path to place the clipped raster
         :param bounds (left, bottom, right, top) bounds in WGS 84 projection
+        :param max_size Maximum number of pixels on either side of the result
+        :return (data, meta) where data is the clipped int32 array and meta the profile to write it with
     """
 
-    wgs_crs = CRS({'init': 'epsg:4326'})  # WGS 84 Projection
-
     with rasterio.open(input_path, 'r') as src:
 
-        window = src.window(*transform_bounds(wgs_crs, src.crs, *bounds))
+        window = snapped_window(src, bounds)
         height = window[0][1] - window[0][0]
         width = window[1][1] - window[1][0]
-        t = 2048    # Threshold, for if the user selects an area greater than 2048 pixels in size
-                    # If so, select the center of the area at size of 2048 by 2048
-        if width > t:
-            if width % 2 != 0:
-                width -= 1
-            trim = int((width - t) / 2)
-            width = t
-            window = (window[0], (window[1][0] + trim, window[1][0] + t + trim))
-
-        if height > t:
-            if height % 2 != 0:
-                height -= 1
-            trim = int((height - t) / 2)
-            height = t
-            window = ((window[0][0] + trim, window[0][0] + t + trim), window[1])
-
-        out_kwargs = src.meta.copy()
-        out_kwargs.update({
-            'height': height,
-            'width': width,
-            'transform': src.window_transform(window),
+        out_height, out_width = decimated_shape(window, max_size)
+
+        data = np.empty((out_height, out_width), dtype=src.dtypes[0])
+        src.read(1, window=window, out=data)
+
+        meta = src.meta.copy()
+        meta.update({
+            'height': out_height,
+            'width': out_width,
+            'transform': src.window_transform(window) * Affine.scale(width / max(out_width, 1),
+                                                                      height / max(out_height, 1)),
             'dtype': 'int32',   # SyncroSim needs a signed int32
             'nodata': 0
             })
 
-        with rasterio.open(output_path, 'w', **out_kwargs) as dst:
-            dst.write(src.read(1, window=window).astype('int32'), 1)
+    return data.astype('int32'), meta
 
 
-def elevation_stats(raster_path):
+def write_raster(output_path, data, meta):
+    """
+        Writes an array read by read_clip out to a GeoTIFF.
+        :param output_path The path to place the raster
+        :param data The array to write
+        :param meta The profile returned alongside the array
+    """
+
+    with rasterio.open(output_path, 'w', **meta) as dst:
+        dst.write(data.astype(meta['dtype']), 1)
+
+
+def clip_from_wgs(input_path, output_path, bounds, max_size=2048):
+    """
+        Clips a raster based on WGS coordinates.
+        :param input_path The path to the raster to clip out of
+        :param output_path The path to place the clipped raster
+        :param bounds (left, bottom, right, top) bounds in WGS 84 projection
+        :param max_size Maximum number of pixels on either side of the clipped raster
+    """
+
+    data, meta = read_clip(input_path, bounds, max_size)
+    write_raster(output_path, data, meta)
+
+
+def elevation_array_stats(elev_data):
 
     stats = dict()
+    stats['dem_max'] = int(np.max(elev_data))
+    stats['dem_min'] = int(np.min(elev_data))
+    stats['dem_width'] = int(elev_data.shape[1])
+    stats['dem_height'] = int(elev_data.shape[0])
+    return stats
+
+
+def elevation_stats(raster_path):
 
     with rasterio.open(raster_path, 'r') as src:
-        elev_data = src.read(1)
-        stats['dem_max'] = int(np.max(elev_data))
-        stats['dem_min'] = int(np.min(elev_data))
-        stats['dem_width'] = int(elev_data.shape[1])
-        stats['dem_height'] = int(elev_data.shape[0])
+        return elevation_array_stats(src.read(1))
 
-    return stats
+
+def vegetation_array_stats(strata_data):
+    stats = dict()
+    total = strata_data.size
+    codes, counts = np.unique(strata_data.astype('int32'), return_counts=True)
+    for code, count in zip(codes, counts):
+        stats[int(code)] = (int(count) / total) * 100   # convert to percentage
+    return stats, total
 
 
 def vegetation_stats(raster_path):
-    stats = dict()
     with rasterio.open(raster_path, 'r') as src:
-        strata_data = src.read(1).astype('int32')
-        total = strata_data.size
-        unique_codes = list(np.unique(strata_data))
-        for code in unique_codes:
-            stats[code] = (int((strata_data == code).sum()) / total) * 100   # numpy sum function, convert to percentage
-    return stats, total
+        return vegetation_array_stats(src.read(1))
 
 
-def zonal_stateclass_stats(veg_path, sc_path, sc_defs):
-    veg_stats, total_landscape = vegetation_stats(veg_path)
+def crosstab(veg_data, sc_data):
+    """
+        Counts the cells of every (vegtype, stateclass) pair in a single pass.
+        :param veg_data Array of vegtype codes
+        :param sc_data Array of stateclass codes, the same shape as veg_data
+        :return (veg_codes, sc_codes, counts) where counts[i, j] is the number of cells
+            with vegtype veg_codes[i] and stateclass sc_codes[j]
+    """
+    veg_codes, veg_index = np.unique(veg_data, return_inverse=True)
+    sc_codes, sc_index = np.unique(sc_data, return_inverse=True)
+    combined = veg_index.ravel().astype('int64') * sc_codes.size + sc_index.ravel()
+    counts = np.bincount(combined, minlength=veg_codes.size * sc_codes.size)
+    return veg_codes, sc_codes, counts.reshape(veg_codes.size, sc_codes.size)
+
+
+def zonal_stateclass_array_stats(veg_data, sc_data, sc_defs):
+    """
+        Percent cover of each stateclass within each vegtype, relative to the whole landscape.
+        :param veg_data Array of vegtype codes
+        :param sc_data Array of stateclass codes, the same shape as veg_data
+        :param sc_defs The stateclass definitions
+    """
+    total_landscape = veg_data.size
+    available_sc_ids = set(int(sc_defs[sc]['ID']) for sc in sc_defs)
+    veg_codes, sc_codes, counts = crosstab(veg_data.astype('int32'), sc_data)
+    sc_columns = [(int(sc_code), j) for j, sc_code in enumerate(sc_codes) if int(sc_code) in available_sc_ids]
+
     zonal_stateclass_results = dict()
-    stateclass_total = 0
-    available_sc_ids = [int(sc_defs[sc]['ID']) for sc in sc_defs]
-    with rasterio.open(sc_path, 'r') as sc_src:
-        sc_data = sc_src.read(1)
-        unique_sc = [id for id in list(np.unique(sc_data)) if id in available_sc_ids]
-        with rasterio.open(veg_path, 'r') as veg_src:
-            veg_data = veg_src.read(1)
-            for veg_code in veg_stats.keys():
-                for sc_code in unique_sc:
-                    sc_cover_by_veg = np.where(sc_data[np.where(veg_data == veg_code)] == sc_code)[0].size
-                    stateclass_total += sc_cover_by_veg if int(sc_code) != 0 else 0
-                    if veg_code not in zonal_stateclass_results:
-                        zonal_stateclass_results[veg_code] = dict()
-                    zonal_stateclass_results[veg_code][sc_code] = (sc_cover_by_veg / total_landscape) * 100
+    for i, veg_code in enumerate(veg_codes):
+        if len(sc_columns) == 0:
+            break   # no defined stateclass in the clip, so no vegtype has any cover to report
+        zonal_stateclass_results[int(veg_code)] = {
+            sc_code: (int(counts[i, j]) / total_landscape) * 100 for sc_code, j in sc_columns
+        }
+    stateclass_total = sum(int(counts[:, j].sum()) for sc_code, j in sc_columns if sc_code != 0)
     return zonal_stateclass_results, total_landscape, stateclass_total
+
+
+def zonal_stateclass_stats(veg_path, sc_path, sc_defs):
+    with rasterio.open(veg_path, 'r') as veg_src, rasterio.open(sc_path, 'r') as sc_src:
+        return zonal_stateclass_array_stats(veg_src.read(1), sc_src.read(1), sc_defs)
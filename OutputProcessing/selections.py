@@ -0,0 +1,340 @@
+"""
+    One-read processing of a selected spatial extent.
+
+    A selection is only a record of the bounds the user picked, identified by a hash of the
+    library and the bounds snapped to the source pixel grid, so selecting the same area again
+    reuses everything already computed for it. For one selection the
+    frontend requests the sc, veg and elev textures and the zonal statistics separately.
+    Rather than decoding the same rasters for each of those requests, the first request
+    clips every raster into memory once, computes all the textures and statistics from
+    those arrays and keeps the results in the cache, where the remaining requests pick
+    them up. GeoTIFFs are only written when a spatial model run needs to hand them to
+    SyncroSim. Everything a selection leaves on disk lives in a size-bounded store that
+    evicts the least recently used selections first.
+"""
+
+import os
+import json
+import hashlib
+import threading
+import rasterio
+from io import BytesIO
+from uuid import UUID
+from django.conf import settings
+from django.core.cache import caches
+from OutputProcessing import texture_utils, raster_utils
+from OutputProcessing.plugins import lookups, conversions
+from Heightmaps.plugins import heights
+from Sagebrush.stsim_utils import stsim_manager
+
+PREDEFINED_EXTENT = 'predefined-extent'
+
+# Seconds to keep the processed products of a selection around
+SELECTION_TIMEOUT = getattr(settings, 'STSIM_SELECTION_TIMEOUT', 60 * 60)
+
+# Largest number of pixels on either side of a selection; larger areas are read decimated
+SELECTION_MAX_SIZE = getattr(settings, 'STSIM_SELECTION_MAX_SIZE', 2048)
+
+# Bytes of selection artifacts to keep on disk, per library output directory
+SELECTION_STORE_BYTES = getattr(settings, 'STSIM_SELECTION_STORE_BYTES', 1 << 30)
+
+_build_locks = dict()
+_build_locks_guard = threading.Lock()
+
+
+def selection_cache():
+    return caches[getattr(settings, 'STSIM_SELECTION_CACHE', 'default')]
+
+
+def record_path(library, raster_uuid):
+    return os.path.join(stsim_manager.output_paths[library], raster_uuid + '-selection.json')
+
+
+def selection_id(library, window):
+    """
+    Content-addressed id of a selection. Bounds are snapped to the pixel grid of the vegetation
+    raster, so boxes that only differ by map jitter within a cell share an id. The id is formatted
+    as a version 4 UUID to fit the existing urls.
+    :param library: Name of the library in the STSIM_CONFIG
+    :param window: The selected window of the vegetation raster
+    """
+    key = '{library}|{window}|{size}'.format(library=library, window=window, size=SELECTION_MAX_SIZE)
+    return str(UUID(bytes=hashlib.sha1(key.encode('utf-8')).digest()[:16], version=4))
+
+
+def is_selection_id(value):
+    try:
+        return str(UUID(value)) == value
+    except ValueError:
+        return False
+
+
+def select(library, bounds):
+    """
+    Records a selection, or reuses the existing record of the same area.
+    :param library: Name of the library in the STSIM_CONFIG
+    :param bounds: (left, bottom, right, top) bounds in WGS 84 projection
+    :return: The id of the selection
+    """
+    window = raster_utils.wgs_window(stsim_manager.veg_paths[library], bounds)
+    raster_uuid = selection_id(library, window)
+    path = record_path(library, raster_uuid)
+    if os.path.exists(path):
+        touch_selection(library, raster_uuid)
+    else:
+        with open(path, 'w') as f:
+            json.dump({'library': library,
+                       'bounds': list(bounds),
+                       'cell_scale': raster_utils.cell_scale(window, SELECTION_MAX_SIZE)}, f)
+    return raster_uuid
+
+
+def touch_selection(library, raster_uuid):
+    """ Marks a selection as recently used. """
+    try:
+        os.utime(record_path(library, raster_uuid), None)
+    except FileNotFoundError:
+        pass
+
+
+def evict_selections(library, keep=()):
+    """
+    Removes the least recently used selection artifacts until the library's output directory
+    fits in STSIM_SELECTION_STORE_BYTES.
+    :param library: Name of the library in the STSIM_CONFIG
+    :param keep: Ids of selections that must not be removed, e.g. those referenced by running models.
+    """
+    output_path = stsim_manager.output_paths[library]
+    artifacts = dict()
+    for name in os.listdir(output_path):
+        raster_uuid = name[:36]
+        if name[36:37] != '-' or not is_selection_id(raster_uuid):
+            continue
+        path = os.path.join(output_path, name)
+        artifacts.setdefault(raster_uuid, list()).append((path, os.path.getsize(path)))
+
+    total = sum(size for files in artifacts.values() for path, size in files)
+    if total <= SELECTION_STORE_BYTES:
+        return
+
+    def last_used(raster_uuid):
+        path = record_path(library, raster_uuid)
+        return os.path.getmtime(path) if os.path.exists(path) else 0
+
+    keep = set(keep)
+    for raster_uuid in sorted(artifacts.keys(), key=last_used):
+        if total <= SELECTION_STORE_BYTES:
+            break
+        if raster_uuid in keep:
+            continue
+        for path, size in artifacts[raster_uuid]:
+            try:
+                os.remove(path)
+                total -= size
+            except FileNotFoundError:
+                pass
+        selection_cache().delete(products_key(library, raster_uuid))
+
+
+def load_selection(library, raster_uuid):
+    path = record_path(library, raster_uuid)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def clip_selection(library, record):
+    """
+    Clips the elevation, vegetation and stateclass rasters of a selection into memory.
+    The stateclass raster is converted for libraries with lookup fields, unless the library-wide
+    converted raster has been built, in which case it is clipped from that instead.
+    :return: A dict of (data, meta) pairs by raster type
+    """
+    bounds = record['bounds']
+    converted_sc_path = None
+    if stsim_manager.has_lookup_fields[library]:
+        converted_sc_path = conversions.converted_stateclass_path(library)
+
+    clips = {
+        'elev': raster_utils.read_clip(stsim_manager.elev_paths[library], bounds, SELECTION_MAX_SIZE),
+        'veg': raster_utils.read_clip(stsim_manager.veg_paths[library], bounds, SELECTION_MAX_SIZE),
+        'sc': raster_utils.read_clip(converted_sc_path or stsim_manager.sc_paths[library], bounds, SELECTION_MAX_SIZE)
+    }
+    if stsim_manager.has_lookup_fields[library] and converted_sc_path is None:
+        sc_data, sc_meta = clips['sc']
+        sc_data = conversions.convert_arrays(stsim_manager.conversion_functions[library], clips['veg'][0], sc_data)
+        clips['sc'] = (sc_data, sc_meta)
+    return clips
+
+
+def cell_resolution(library, raster_uuid):
+    """
+    Cell size of a selection, taking decimated reads of large selections into account.
+    :param library: Name of the library in the STSIM_CONFIG
+    :param raster_uuid: The selection id, or 'predefined-extent'
+    """
+    resolution = stsim_manager.resolutions[library]
+    record = load_selection(library, raster_uuid) if raster_uuid != PREDEFINED_EXTENT else None
+    if record is None:
+        return resolution
+    return resolution * record.get('cell_scale', 1.0)
+
+
+def read_selection(library, raster_uuid):
+    """
+    The elevation, vegetation and stateclass data of a selection.
+    :param library: Name of the library in the STSIM_CONFIG
+    :param raster_uuid: The selection id, or 'predefined-extent'
+    :return: A dict of arrays by raster type, or None if the selection does not exist for this library.
+    """
+    if stsim_manager.has_predefined_extent[library] != (raster_uuid == PREDEFINED_EXTENT):
+        return None
+
+    if raster_uuid == PREDEFINED_EXTENT:
+        data = dict()
+        paths = {
+            'elev': stsim_manager.elev_paths[library],
+            'veg': stsim_manager.veg_paths[library],
+            'sc': stsim_manager.sc_paths[library]
+        }
+        for raster_type, path in paths.items():
+            with rasterio.open(path, 'r') as src:
+                data[raster_type] = src.read(1)
+        return data
+
+    record = load_selection(library, raster_uuid)
+    if record is None:
+        return None
+    return {raster_type: clip[0] for raster_type, clip in clip_selection(library, record).items()}
+
+
+def materialize_selection(library, raster_uuid):
+    """
+    Writes the vegetation and stateclass GeoTIFFs of a selection, for handing to SyncroSim.
+    :param library: Name of the library in the STSIM_CONFIG
+    :param raster_uuid: The selection id
+    :return: (veg_path, sc_path), or None if the selection does not exist.
+    """
+    output_path = stsim_manager.output_paths[library]
+    sc_ext = 'sc' if not stsim_manager.has_lookup_fields[library] else stsim_manager.conversion_extensions[library]
+    veg_path = os.path.join(output_path, raster_uuid + '-veg.tif')
+    sc_path = os.path.join(output_path, raster_uuid + '-' + sc_ext + '.tif')
+
+    touch_selection(library, raster_uuid)
+    if not (os.path.exists(veg_path) and os.path.exists(sc_path)):
+        record = load_selection(library, raster_uuid)
+        if record is None:
+            return None
+        clips = clip_selection(library, record)
+        raster_utils.write_raster(veg_path, *clips['veg'])
+        raster_utils.write_raster(sc_path, *clips['sc'])
+
+    return veg_path, sc_path
+
+
+def png_bytes(texture):
+    buffer = BytesIO()
+    texture.save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+def selection_stats(library, elev_data, veg_data, sc_data):
+    """ Zonal elevation, vegetation and stateclass statistics, as served by the stats endpoint. """
+
+    # elevation information
+    elev_stats = raster_utils.elevation_array_stats(elev_data)
+
+    # determine vegetation initial coverage by state class
+    veg_state_defs = stsim_manager.all_veg_state_classes[library]
+    vegtype_defs = stsim_manager.vegtype_definitions[library]
+    stateclass_defs = stsim_manager.stateclass_definitions[library]
+    veg_sc_pcts, veg_total, sc_total = raster_utils.zonal_stateclass_array_stats(veg_data, sc_data, stateclass_defs)
+
+    zonal_veg_sc_pcts = dict()
+    for vegtype in veg_state_defs.keys():
+        veg_id = int(vegtype_defs[vegtype]['ID'])
+        if veg_id in veg_sc_pcts.keys():
+            zonal_veg = dict()
+            for sc_type in veg_state_defs[vegtype]:
+                sc_id = int(stateclass_defs[sc_type]['ID'])
+                if sc_id in veg_sc_pcts[veg_id].keys():
+                    zonal_veg[sc_type] = veg_sc_pcts[veg_id][sc_id]
+                else:
+                    zonal_veg[sc_type] = 0
+            zonal_veg_sc_pcts[vegtype] = zonal_veg
+
+    veg_codes = zonal_veg_sc_pcts.keys()
+    if stsim_manager.has_lookup_fields[library]:
+        lookup_function = getattr(lookups, stsim_manager.lookup_functions[library])
+        veg_names = lookup_function(veg_codes, stsim_manager.lookup_fields[library][0])
+    else:
+        veg_names = {name: name for name in veg_codes}
+
+    return {'elev': elev_stats,
+            'veg_sc_pct': zonal_veg_sc_pcts,
+            'veg_names': veg_names,
+            'total_cells': veg_total,
+            'total_active_cells': sc_total}
+
+
+def build_selection(library, data):
+    """
+    Computes the textures and stats of a selection from its arrays.
+    :param library: Name of the library in the STSIM_CONFIG
+    :param data: The arrays, as returned by read_selection
+    """
+
+    if stsim_manager.has_predefined_extent[library]:
+        elev_func = getattr(heights, stsim_manager.heightmap_functions[library])
+        elev_texture = elev_func(stsim_manager.elev_paths[library])
+    else:
+        elev_texture = texture_utils.elevation_array_texture(data['elev'])
+
+    sc_colormap = texture_utils.create_colormap(stsim_manager.stateclass_definitions[library])
+    textures = {
+        'elev': png_bytes(elev_texture),
+        'veg': png_bytes(texture_utils.vegtype_array_texture(
+            data['veg'], veg_defs=stsim_manager.vegtype_definitions[library])),
+        'sc': png_bytes(texture_utils.stateclass_array_texture(data['sc'], sc_colormap))
+    }
+
+    return {'textures': textures,
+            'stats': selection_stats(library, data['elev'], data['veg'], data['sc'])}
+
+
+def products_key(library, raster_uuid):
+    return 'selection:{library}:{uuid}'.format(library=library.replace(' ', '_'), uuid=raster_uuid)
+
+
+def selection_products(library, raster_uuid):
+    """
+    The textures and stats of a selection, computed on first use and cached afterwards.
+    :param library: Name of the library in the STSIM_CONFIG
+    :param raster_uuid: The selection id, or 'predefined-extent'
+    :return: A dict with 'textures' (PNG bytes by raster type) and 'stats', or None if the selection doesn't exist.
+    """
+
+    if raster_uuid != PREDEFINED_EXTENT:
+        touch_selection(library, raster_uuid)
+
+    key = products_key(library, raster_uuid)
+    cache = selection_cache()
+    products = cache.get(key)
+    if products is not None:
+        return products
+
+    # Requests for the same selection arrive together, so only let one of them do the work
+    with _build_locks_guard:
+        lock = _build_locks.setdefault(key, threading.Lock())
+    with lock:
+        products = cache.get(key)
+        if products is None:
+            data = read_selection(library, raster_uuid)
+            if data is not None:
+                products = build_selection(library, data)
+                products['stats']['resolution'] = cell_resolution(library, raster_uuid)
+                cache.set(key, products, SELECTION_TIMEOUT)
+    with _build_locks_guard:
+        _build_locks.pop(key, None)
+    return products
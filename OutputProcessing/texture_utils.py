@@ -1,11 +1,13 @@
 import os
 import rasterio
 import numpy as np
-import numpy_indexed as npi
 from stsimpy import order
 from collections import OrderedDict
 from PIL import Image
 
+# Largest span of codes we will build a dense lookup table for
+MAX_LUT_SIZE = 1 << 24
+
 
 def scale_texture(image, scale):
 
@@ -21,88 +23,122 @@ def scale_texture(image, scale):
     return image.resize((width, height))
 
 
+def elevation_colors(codes):
+    """ Packs elevation values into RGBA colors.
+    Allows for a max of a 24 unsigned integer, and 1 8bit integer for depth below 0
+    :param codes: A sorted int64 array of elevation values.
+    :return: An (N, 4) uint8 array of colors.
+    """
+    colors = np.zeros((codes.size, 4), dtype='uint8')
+    above = codes >= 0
+    colors[above, 0] = codes[above] & 0xFF
+    colors[above, 1] = (codes[above] & 0xFF00) >> 8
+    colors[above, 2] = (codes[above] & 0xFF0000) >> 16
+    colors[above, 3] = 255
+    below = (codes < 0) & (codes >= -255)
+    colors[below, 3] = 255 + codes[below]  # value is negative at this point, so add it
+    return colors
+
+
+def packed_colors(codes):
+    """ Packs integer codes into RGB colors.
+    Allows for a max of a 24 unsigned integer.
+    :param codes: A sorted int64 array of codes.
+    :return: An (N, 3) uint8 array of colors.
+    """
+    colors = np.empty((codes.size, 3), dtype='uint8')
+    colors[:, 0] = codes & 0xFF
+    colors[:, 1] = (codes & 0xFF00) >> 8
+    colors[:, 2] = (codes & 0xFF0000) >> 16
+    return colors
+
+
+def mapped_colors(color_map, channels=3):
+    """ Creates a color function from a {code: (r, g, b)} map.
+    Codes missing from the map keep their own value, clipped to 8 bits, which is what PIL
+    did with the unmapped values we used to hand to Image.putdata.
+    :param color_map: Dictionary of codes to color tuples.
+    :param channels: Number of channels in each color.
+    """
+    keys = np.array(list(color_map.keys()), dtype='int64')
+    values = np.clip(np.array(list(color_map.values()), dtype='int64').reshape(keys.size, channels), 0, 255)
+
+    def colors_for(codes):
+        colors = np.repeat(np.clip(codes, 0, 255).astype('uint8')[:, np.newaxis], channels, axis=1)
+        if keys.size > 0 and codes.size > 0:
+            positions = np.clip(np.searchsorted(codes, keys), 0, codes.size - 1)
+            found = codes[positions] == keys
+            colors[positions[found]] = values[found]
+        return colors
+
+    return colors_for
+
+
+def encode_texture(data, mode, colors_for, scale=None):
+    """ Encodes a 2D array of integer codes into an image with a single lookup table gather.
+    :param data: 2D array of integer codes.
+    :param mode: PIL image mode, 'RGB' or 'RGBA'.
+    :param colors_for: Function mapping a sorted int64 array of codes to an (N, len(mode)) uint8 array.
+    :param scale: Optional scale to apply to the resulting texture.
+    """
+    data = np.asarray(data)
+    shape = data.shape
+    if data.size == 0:
+        return Image.new(mode, (shape[1], shape[0]))
+
+    low = int(data.min())
+    high = int(data.max())
+    if high - low < MAX_LUT_SIZE:
+        # dense lookup table covering every code between the min and max
+        lut = colors_for(np.arange(low, high + 1, dtype='int64'))
+        pixels = lut[data.astype('int64') - low]
+    else:
+        # codes are too spread out for a dense table, so index by the unique codes instead
+        codes, inverse = np.unique(data, return_inverse=True)
+        pixels = colors_for(codes.astype('int64'))[inverse].reshape(shape + (len(mode),))
+
+    texture = Image.fromarray(np.ascontiguousarray(pixels, dtype='uint8'), mode)
+    if scale:
+        texture = scale_texture(texture, scale)
+    return texture
+
+
+def elevation_array_texture(elev_data, scale=None):
+    """ Creates an elevation-encoded image from an elevation array
+    :param elev_data: 2D array of elevation values.
+    """
+    return encode_texture(np.asarray(elev_data).astype('int16'), 'RGBA', elevation_colors, scale)
+
+
 def elevation_texture(elev_path, scale=None):
     """ Creates an elevation-encoded image from a given elevation GeoTiff
     :param elev_path: The path to the elevation to encode into the texture.
     """
     with rasterio.open(elev_path, 'r') as src:
+        elev_data = src.read(1)
+    return elevation_array_texture(elev_data, scale)
 
-        elev_data = src.read(1).astype('int16')
-        shape = elev_data.shape
-        elev_flat = elev_data.ravel()
-
-        # Pack the elevation into the color channels.
-        # Allows for a max of a 24 unsigned integer, and 1 8bit integer for depth below 0
-        unique_codes = [x for x in range(np.min(elev_data), np.max(elev_data)+1)]
-        r_map = dict()
-        g_map = dict()
-        b_map = dict()
-        a_map = dict()
-        for value in list(unique_codes):
-            if value >= 0:
-                r_map[value] = (value & 0xFF)
-                g_map[value] = (value & 0xFF00) >> 8
-                b_map[value] = (value & 0xFF0000) >> 16
-                a_map[value] = 255
-            elif value < -255:
-                r_map[value] = g_map[value] = b_map[value] = a_map[value] = 0
-            else:
-                r_map[value] = g_map[value] = b_map[value] = 0
-                a_map[value] = 255 + value  # value is negative at this point, so add it
-
-        image_shape = (shape[1], shape[0])  # images are column major
-        texture = Image.new('RGBA', image_shape)
-        r_array = npi.remap(elev_flat, list(r_map.keys()), list(r_map.values()))
-        g_array = npi.remap(elev_flat, list(g_map.keys()), list(g_map.values()))
-        b_array = npi.remap(elev_flat, list(b_map.keys()), list(b_map.values()))
-        a_array = npi.remap(elev_flat, list(a_map.keys()), list(a_map.values()))
-        image_data = [(r_array[i], g_array[i], b_array[i], a_array[i]) for i in range(shape[0] * shape[1])]
-        texture.putdata(image_data)
-        if scale:
-            texture = scale_texture(texture, scale)
-    return texture
+
+def vegtype_array_texture(strata_data, veg_defs=None, scale=None):
+    """ Creates a type-encoded image from a strata array
+    :param strata_data: 2D array of vegtype codes.
+    """
+    if veg_defs is None:
+        colors_for = packed_colors
+    else:
+        colormap = create_colormap(veg_defs)
+        colors_for = mapped_colors({int(row['ID']): (int(row['r']), int(row['g']), int(row['b']))
+                                    for row in colormap})
+    return encode_texture(np.asarray(strata_data).astype('int32'), 'RGB', colors_for, scale)
 
 
 def vegtype_texture(strata_path, veg_defs=None, scale=None):
     """ Creates a type-encoded image from a given strata GeoTiff
     :param strata_path: The path to the vegtype to encode into the texture.
     """
-
     with rasterio.open(strata_path, 'r') as src:
-
-        strata_data = src.read(1).astype('int32')
-        shape = strata_data.shape
-        strata_flat = strata_data.ravel()
-
-        r_map = dict()
-        g_map = dict()
-        b_map = dict()
-        if veg_defs is None:
-            # Pack the codes into the color channels.
-            # Allows for a max of a 24 unsigned integer.
-            unique_codes = np.unique(strata_flat)
-            for value in list(unique_codes):
-                r_map[value] = (value & 0xFF)
-                g_map[value] = (value & 0xFF00) >> 8
-                b_map[value] = (value & 0xFF0000) >> 16
-        else:
-            colormap = create_colormap(veg_defs)
-            for row in colormap:
-                idx = int(row['ID'])
-                r_map[idx] = int(row['r'])
-                g_map[idx] = int(row['g'])
-                b_map[idx] = int(row['b'])
-
-        image_shape = (shape[1], shape[0])  # images are column major
-        texture = Image.new('RGB', image_shape)
-        r_array = npi.remap(strata_flat, list(r_map.keys()), list(r_map.values()))
-        g_array = npi.remap(strata_flat, list(g_map.keys()), list(g_map.values()))
-        b_array = npi.remap(strata_flat, list(b_map.keys()), list(b_map.values()))
-        image_data = [(r_array[i], g_array[i], b_array[i]) for i in range(shape[0] * shape[1])]
-        texture.putdata(image_data)
-        if scale:
-            texture = scale_texture(texture, scale)
-    return texture
+        strata_data = src.read(1)
+    return vegtype_array_texture(strata_data, veg_defs, scale)
 
 
 def create_colormap(stsim_defs):
@@ -152,46 +188,30 @@ def create_rgb_colormap(definitions, decode_from_id=False):
     return OrderedDict(sorted(rgb_colormap.items(), key=order()))
 
 
+def stateclass_colors(colormap):
+    """ Creates a color function for stateclass codes, with fill and zero values drawn as black. """
+    color_map = {-9999: (0, 0, 0), 0: (0, 0, 0)}
+    for row in colormap:
+        color_map[int(row['ID'])] = (int(row['r']), int(row['g']), int(row['b']))
+    return mapped_colors(color_map)
+
+
+def stateclass_array_texture(sc_data, colormap, scale=None):
+    """ Creates a true-color image from a stateclass array
+    :param sc_data: 2D array of stateclass codes.
+    :param colormap: The colormap, as created by create_colormap.
+    """
+    # cast the values to integers since they are uniquely identifiable
+    return encode_texture(np.asarray(sc_data).astype('int32'), 'RGB', stateclass_colors(colormap), scale)
+
+
 def stateclass_texture(sc_tif, colormap, scale=None):
     """ Creates a true-color image from a given strata GeoTiff
     :param strata_path: The path to the vegtype to encode into the texture.
     """
-    r_map = dict()
-    g_map = dict()
-    b_map = dict()
-
-    fill = -9999
-    zero = 0
-    r_map[fill] = g_map[fill] = b_map[fill] = r_map[zero] = g_map[zero] = b_map[zero] = 0
-
-    for row in colormap:
-        idx = int(row['ID'])
-        r_map[idx] = int(row['r'])
-        g_map[idx] = int(row['g'])
-        b_map[idx] = int(row['b'])
-
-    # open the stateclass geotiff and get as a linear array
     with rasterio.open(sc_tif, 'r') as src:
-        # cast the values to integers since they are uniquely identifiable
-        sc_data = src.read(1).astype('int32')
-        shape = sc_data.shape
-        sc_flat = sc_data.ravel()
-        # copy and remap the numpy arrays to the rgb values we want
-        sc_copy = np.copy(sc_flat)
-        r_array = npi.remap(sc_copy, list(r_map.keys()), list(r_map.values()))
-        g_array = npi.remap(sc_copy, list(g_map.keys()), list(g_map.values()))
-        b_array = npi.remap(sc_copy, list(b_map.keys()), list(b_map.values()))
-
-        # get construct the image data based on the mapped values
-        image_data = [(r_array[i], g_array[i], b_array[i]) for i in range(shape[0] * shape[1])]
-
-        # build the png image
-        image_shape = (shape[1], shape[0])  # images are column major
-        texture = Image.new('RGB', image_shape)
-        texture.putdata(image_data)
-        if scale:
-            texture = scale_texture(texture, scale)
-    return texture
+        sc_data = src.read(1)
+    return stateclass_array_texture(sc_data, colormap, scale)
 
 
 def process_stateclass_directory(dir_path, sc_defs):
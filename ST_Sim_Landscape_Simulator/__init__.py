@@ -0,0 +1 @@
+default_app_config = 'ST_Sim_Landscape_Simulator.apps.SimulatorConfig'
@@ -5,4 +5,7 @@ from django.apps import AppConfig
 
 class SimulatorConfig(AppConfig):
 	
-	name = 'ST_Sim_Landscape_Simulator'
\ No newline at end of file
+	name = 'ST_Sim_Landscape_Simulator'
+
+	def ready(self):
+		from . import notifications    # registers the check for a shared state cache
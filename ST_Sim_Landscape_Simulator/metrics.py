@@ -0,0 +1,82 @@
+"""
+    Performance metrics of model runs, for capacity planning.
+"""
+
+import numpy as np
+from datetime import timedelta
+from django.db.models import Q
+from django.utils import timezone
+from .models import STSimModelRun
+from . import result_cache
+
+PERCENTILES = (50, 90, 95, 99)
+
+# Each stage is timed from the first timestamp to the second
+STAGES = {
+    'queue_wait': ('enqueued_at', 'dequeued_at'),
+    'prepare': ('dequeued_at', 'prepared_at'),
+    'run': ('started_at', 'finished_at'),
+    'export': ('finished_at', 'exported_at'),
+    'total': ('enqueued_at', 'exported_at'),
+}
+
+SIZES = ('cells', 'iterations', 'timesteps')
+
+
+def percentiles(values):
+    """ Count, mean and percentiles of a list of values, None where there are no values. """
+    summary = {'count': len(values), 'mean': None}
+    summary.update({'p{}'.format(p): None for p in PERCENTILES})
+    if len(values) > 0:
+        values = np.asarray(values, dtype=float)
+        summary['mean'] = float(values.mean())
+        summary.update({'p{}'.format(p): float(np.percentile(values, p)) for p in PERCENTILES})
+    return summary
+
+
+def stage_seconds(runs, start, end):
+    return [(run[end] - run[start]).total_seconds() for run in runs
+            if run[start] is not None and run[end] is not None]
+
+
+def run_metrics(library, days=7):
+    """
+    Stage durations and run sizes of the model runs of a library, as percentiles.
+    Runs split into shards are counted once, as a whole; their shards are summarized separately.
+    :param library: Name of the library in the STSIM_CONFIG
+    :param days: How far back to look
+    """
+    fields = set(field for stage in STAGES.values() for field in stage) | set(SIZES) | {'is_spatial', 'worker'}
+    recent = STSimModelRun.objects \
+        .filter(library=library, enqueued_at__gte=timezone.now() - timedelta(days=days)) \
+        .exclude(parameters='')
+    # shards are the members of a run with parameters, whereas batches have none
+    is_shard = Q(parent__isnull=False) & ~Q(parent__parameters='')
+    runs = list(recent.exclude(is_shard).values(*fields))
+    completed = [run for run in runs if run['exported_at'] is not None]
+    shards = [run for run in recent.filter(is_shard).values(*fields) if run['exported_at'] is not None]
+
+    def summarize(selected):
+        return {
+            'stages': {stage: percentiles(stage_seconds(selected, start, end))
+                       for stage, (start, end) in STAGES.items()},
+            'sizes': {size: percentiles([run[size] for run in selected]) for size in SIZES}
+        }
+
+    workers = dict()
+    for run in completed + shards:
+        if len(run['worker']) > 0:
+            workers[run['worker']] = workers.get(run['worker'], 0) + 1
+
+    return {
+        'library': library,
+        'days': days,
+        'enqueued': len(runs),
+        'completed': len(completed),
+        'all': summarize(completed),
+        'spatial': summarize([run for run in completed if run['is_spatial']]),
+        'nonspatial': summarize([run for run in completed if not run['is_spatial']]),
+        'shards': summarize(shards),
+        'runs_by_worker': workers,
+        'result_cache': result_cache.counters(library)
+    }
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ST_Sim_Landscape_Simulator', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stsimmodelrun',
+            name='raster_uuid',
+            field=models.CharField(blank=True, default='', max_length=36),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ST_Sim_Landscape_Simulator', '0002_stsimmodelrun_raster_uuid'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stsimmodelrun',
+            name='library',
+            field=models.CharField(blank=True, default='', max_length=100),
+        ),
+        migrations.AddField(
+            model_name='stsimmodelrun',
+            name='console_slot',
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ST_Sim_Landscape_Simulator', '0003_stsimmodelrun_console_slot'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stsimmodelrun',
+            name='parameters',
+            field=models.TextField(blank=True, default=''),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ST_Sim_Landscape_Simulator', '0004_stsimmodelrun_parameters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stsimmodelrun',
+            name='parameters_hash',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=40),
+        ),
+        migrations.AddField(
+            model_name='stsimmodelrun',
+            name='created',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
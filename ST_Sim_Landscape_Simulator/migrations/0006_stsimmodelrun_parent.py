@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ST_Sim_Landscape_Simulator', '0005_stsimmodelrun_parameters_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stsimmodelrun',
+            name='parent',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE,
+                                    related_name='members', to='ST_Sim_Landscape_Simulator.STSimModelRun'),
+        ),
+        migrations.AddField(
+            model_name='stsimmodelrun',
+            name='results',
+            field=models.TextField(blank=True, default=''),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ST_Sim_Landscape_Simulator', '0006_stsimmodelrun_parent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stsimmodelrun',
+            name='progress',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='stsimmodelrun',
+            name='current_iteration',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='stsimmodelrun',
+            name='current_timestep',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='stsimmodelrun',
+            name='task_id',
+            field=models.CharField(blank=True, default='', max_length=50),
+        ),
+        migrations.AddField(
+            model_name='stsimmodelrun',
+            name='holds_console',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='stsimmodelrun',
+            name='cancelled',
+            field=models.BooleanField(default=False),
+        ),
+    ]
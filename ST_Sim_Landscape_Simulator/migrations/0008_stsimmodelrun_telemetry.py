@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ST_Sim_Landscape_Simulator', '0007_stsimmodelrun_progress'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stsimmodelrun',
+            name='cells',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='stsimmodelrun',
+            name='iterations',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='stsimmodelrun',
+            name='timesteps',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='stsimmodelrun',
+            name='is_spatial',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='stsimmodelrun',
+            name='enqueued_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='stsimmodelrun',
+            name='dequeued_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='stsimmodelrun',
+            name='prepared_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='stsimmodelrun',
+            name='started_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='stsimmodelrun',
+            name='finished_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='stsimmodelrun',
+            name='exported_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='stsimmodelrun',
+            name='worker',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+    ]
@@ -1,4 +1,7 @@
+import os
+from django.conf import settings
 from django.db import models
+from django.utils import timezone
 
 # Create your models here.
 
@@ -6,5 +9,82 @@ class STSimModelRun(models.Model):
 
     scenario_id = models.IntegerField()
     result_scenario_id = models.IntegerField(default=-1)
+    raster_uuid = models.CharField(max_length=36, blank=True, default='')
+    library = models.CharField(max_length=100, blank=True, default='')
+    console_slot = models.IntegerField(default=0)
+    parameters = models.TextField(blank=True, default='')     # json of the run settings
+    parameters_hash = models.CharField(max_length=40, blank=True, default='', db_index=True)
+    created = models.DateTimeField(default=timezone.now)
+    parent = models.ForeignKey('self', null=True, blank=True, related_name='members', on_delete=models.CASCADE)
+    results = models.TextField(blank=True, default='')    # json of the results of a batch or a sharded run
+    source = models.ForeignKey('self', null=True, blank=True, related_name='reuses',
+                               on_delete=models.SET_NULL)   # earlier run whose results this run reuses
+    progress = models.FloatField(default=0)   # percent of the iterations and timesteps done
+    current_iteration = models.IntegerField(default=0)
+    current_timestep = models.IntegerField(default=0)
+    partial_results = models.TextField(blank=True, default='')    # json of the summary of the timesteps done so far
+    task_id = models.CharField(max_length=50, blank=True, default='')    # celery task currently working on the run
+    holds_console = models.BooleanField(default=False)    # whether the run has a working copy checked out
+    lease_token = models.CharField(max_length=32, blank=True, default='')     # token of the lease on the working copy
+    cancelled = models.BooleanField(default=False)
+    failure = models.CharField(max_length=16, blank=True, default='')     # 'failed', 'timed_out' or 'expired'
 
+    # size of the run
+    cells = models.IntegerField(default=0)
+    iterations = models.IntegerField(default=0)
+    timesteps = models.IntegerField(default=0)
+    is_spatial = models.BooleanField(default=False)
 
+    # when the run reached each stage, and the worker it ran on
+    enqueued_at = models.DateTimeField(null=True, blank=True)
+    dequeued_at = models.DateTimeField(null=True, blank=True)
+    prepared_at = models.DateTimeField(null=True, blank=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    exported_at = models.DateTimeField(null=True, blank=True)
+    worker = models.CharField(max_length=255, blank=True, default='')
+    deadline = models.DateTimeField(null=True, blank=True)    # when the run must have left the queue by
+
+    @staticmethod
+    def size_fields(parameters):
+        """ The size fields of a run with the given parameters. """
+        return {
+            'cells': parameters['total_active_cells'],
+            'iterations': parameters['iterations'],
+            'timesteps': parameters['timesteps'],
+            'is_spatial': parameters['is_spatial']
+        }
+
+    def output_directory(self):
+        """ Where the spatial outputs of the run are kept once it completed, out of reach of slot recycling. """
+        if self.source_id is not None:
+            return self.source.output_directory()
+        return os.path.join(settings.STSIM_WORKING_DIR, 'outputs', self.library, str(self.pk))
+
+    def mark(self, stage):
+        """ Record that the run reached a stage, e.g. 'started', now. """
+        setattr(self, stage + '_at', timezone.now())
+        STSimModelRun.objects.filter(pk=self.pk).update(**{stage + '_at': getattr(self, stage + '_at')})
+
+    def state(self):
+        """ A token that changes whenever there is news about the run, for clients waiting on it. """
+        if self.cancelled:
+            return 'cancelled'
+        if len(self.failure) > 0:
+            return self.failure
+        if self.result_scenario_id != -1:
+            return 'complete'
+        if self.expired():
+            return 'expired'
+        return 'running:{}:{}'.format(self.current_iteration, self.current_timestep)
+
+    def expired(self):
+        """ Whether the run was dropped from the queue for not starting before its deadline. """
+        return self.dequeued_at is None and self.deadline is not None and self.deadline < timezone.now()
+
+    @classmethod
+    def running_selections(cls):
+        """ Ids of the selections referenced by model runs that haven't finished, and still may. """
+        expired = models.Q(dequeued_at__isnull=True, deadline__lt=timezone.now())
+        return set(cls.objects.filter(result_scenario_id=-1, cancelled=False, failure='', members__isnull=True)
+                   .exclude(expired).values_list('raster_uuid', flat=True))
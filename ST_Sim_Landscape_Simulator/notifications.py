@@ -0,0 +1,94 @@
+"""
+    Run state notifications, shared through the Django cache.
+
+    Tasks publish the state of a model run whenever it changes, and waiting
+    status requests watch the cache, reading the database only once something
+    was published or the wait is over. This needs a cache shared by the web
+    and celery processes, e.g. memcached or redis, named by STSIM_STATUS_CACHE.
+    With a per-process cache nothing published by the workers ever arrives,
+    so status requests answer right away and clients fall back to polling
+    every STATUS_POLL_INTERVAL.
+"""
+
+import time
+from django.conf import settings
+from django.core import checks
+from django.core.cache import caches
+
+# Longest a status request is held open waiting for a change, in seconds
+STATUS_WAIT = getattr(settings, 'STSIM_STATUS_WAIT', 25)
+
+# How often a waiting status request checks for a change, in seconds
+STATUS_WAIT_INTERVAL = getattr(settings, 'STSIM_STATUS_WAIT_INTERVAL', 0.25)
+
+# How often clients poll for the status instead, when there is no shared cache to wait on, in seconds
+STATUS_POLL_INTERVAL = getattr(settings, 'STSIM_STATUS_POLL_INTERVAL', 20)
+
+# Published states are kept for a day, long after anyone could be waiting on them
+STATE_TIMEOUT = 24 * 60 * 60
+
+# Cache backends that live in each process, so the web processes never see what the workers store
+PROCESS_LOCAL_BACKENDS = ('django.core.cache.backends.locmem.LocMemCache',
+                          'django.core.cache.backends.dummy.DummyCache')
+
+
+def state_cache_name():
+    return getattr(settings, 'STSIM_STATUS_CACHE', 'default')
+
+
+def state_cache():
+    return caches[state_cache_name()]
+
+
+def shared_state_cache():
+    """ Whether the state cache is shared by the web and celery processes. """
+    backend = settings.CACHES.get(state_cache_name(), {}).get('BACKEND', PROCESS_LOCAL_BACKENDS[0])
+    return backend not in PROCESS_LOCAL_BACKENDS
+
+
+@checks.register()
+def check_state_cache(app_configs, **kwargs):
+    if shared_state_cache():
+        return []
+    return [checks.Warning(
+        'The {} cache is local to each process, so run states published by the celery workers never reach '
+        'the web processes.'.format(state_cache_name()),
+        hint='Configure STSIM_STATUS_CACHE, or the default cache, with a shared backend such as memcached or redis.',
+        id='ST_Sim_Landscape_Simulator.W001')]
+
+
+def state_key(model_run_id):
+    return 'stsim-run-state:{}'.format(model_run_id)
+
+
+def publish(model_run_id, state):
+    """ Announce the new state of a model run to anyone waiting on it. """
+    state_cache().set(state_key(model_run_id), state, STATE_TIMEOUT)
+
+
+def wait_for_change(model_run_id, known_state, load_state, timeout=STATUS_WAIT):
+    """
+    Block until the state of a model run differs from the state the client knows, or the timeout passes.
+    The database is only read once a new state was published, or when the wait is over.
+    :param model_run_id: The model run
+    :param known_state: The state the client last saw
+    :param load_state: Reads the state from the database
+    :param timeout: Seconds to wait at most
+    :return: The latest state, as read from the database
+    """
+    cache = state_cache()
+    key = state_key(model_run_id)
+    published = cache.get(key)
+    if not shared_state_cache() or (published is not None and published != known_state):
+        return load_state()
+
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        time.sleep(STATUS_WAIT_INTERVAL)
+        latest = cache.get(key)
+        if latest != published:
+            published = latest
+            state = load_state()
+            if state != known_state:
+                return state
+    return load_state()
@@ -0,0 +1,89 @@
+"""
+    Progress of running models.
+
+    While the console runs a model, a monitor thread watches the summary output
+    the run writes into its working copy. It records the current iteration and
+    timestep on the model run, along with the partial stateclass summary, so
+    clients can show results as they arrive. Once the run is
+    cancelled, the monitor stops the console, letting the run's task return
+    the working copy.
+"""
+
+import json
+import sqlite3
+import threading
+from django import db
+from django.conf import settings
+from Sagebrush import stsim_sql
+from Sagebrush.stsim_utils import stop_console_processes
+from .models import STSimModelRun
+from . import notifications
+
+# Seconds between checks of the output of a running model
+PROGRESS_INTERVAL = getattr(settings, 'STSIM_PROGRESS_INTERVAL', 2)
+
+
+def partial_summary(model_run):
+    """ The stateclass summary of the timesteps a running model completed so far, or None. """
+    return json.loads(model_run.partial_results) if len(model_run.partial_results) > 0 else None
+
+
+class ProgressMonitor(threading.Thread):
+    """
+        Watches the output of a model running in a working copy, for as long as the run lasts or until it's cancelled.
+    """
+
+    def __init__(self, model_run, library, interval=PROGRESS_INTERVAL):
+        super().__init__(daemon=True)
+        parameters = json.loads(model_run.parameters)
+        self.model_run_id = model_run.pk
+        self.total_steps = parameters['iterations'] * (parameters['timesteps'] + 1)
+        self.library = library
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.last_progress = None
+
+        # output of earlier runs in the working copy, read before this run starts writing
+        try:
+            self.after_sid = stsim_sql.latest_output_scenario(self.library)
+        except sqlite3.Error:
+            self.after_sid = None
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def run(self):
+        try:
+            while not self.stopped.wait(self.interval):
+                if STSimModelRun.objects.filter(pk=self.model_run_id, cancelled=True).exists():
+                    stop_console_processes()    # the run's task waits on the console and returns the working copy
+                    return
+                if self.after_sid is not None:
+                    self.check()
+        finally:
+            self.library.close()
+            db.connection.close()
+
+    def check(self):
+        try:
+            progress = stsim_sql.output_progress(self.library, self.after_sid)
+        except sqlite3.Error:
+            return
+        if progress is None or progress == self.last_progress:
+            return
+        self.last_progress = progress
+        sid, iteration, timestep, steps = progress
+
+        fields = {
+            'current_iteration': iteration,
+            'current_timestep': timestep,
+            'progress': min(100.0, 100.0 * steps / self.total_steps) if self.total_steps > 0 else 0
+        }
+        try:
+            fields['partial_results'] = json.dumps(stsim_sql.stateclass_summary(self.library, sid),
+                                                   separators=(',', ':'))
+        except sqlite3.Error:
+            pass
+        STSimModelRun.objects.filter(pk=self.model_run_id).update(**fields)
+        notifications.publish(self.model_run_id, 'running:{}:{}'.format(iteration, timestep))
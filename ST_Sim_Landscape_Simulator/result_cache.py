@@ -0,0 +1,91 @@
+"""
+    Memoization of model runs by their parameters.
+
+    A run is identified by a hash of its normalized parameters, the scenario and
+    selection it runs on and the version of the library. Re-running an identical
+    configuration hands back the completed run instead of queueing a new one.
+"""
+
+import json
+from datetime import timedelta
+from hashlib import sha1
+from django.conf import settings
+from django.core.cache import caches
+from django.utils import timezone
+from Sagebrush.stsim_utils import stsim_manager
+from .models import STSimModelRun
+
+# Completed runs older than this many seconds are run again rather than reused
+RESULT_CACHE_AGE = getattr(settings, 'STSIM_RESULT_CACHE_AGE', 7 * 24 * 60 * 60)
+
+# Number of completed runs per library kept available for reuse
+RESULT_CACHE_SIZE = getattr(settings, 'STSIM_RESULT_CACHE_SIZE', 1000)
+
+
+def counters_cache():
+    return caches[getattr(settings, 'STSIM_RESULT_CACHE', 'default')]
+
+
+def parameters_hash(library, scenario_id, raster_uuid, parameters):
+    """
+    Canonical hash of everything a model run's results depend on.
+    :param library: Name of the library in the STSIM_CONFIG
+    :param scenario_id: The scenario the run is based on
+    :param raster_uuid: The selection id, or 'predefined-extent'
+    :param parameters: The normalized run parameters
+    """
+    key = {
+        'library': library,
+        'library_version': stsim_manager.library_stamp(library),
+        'scenario_id': int(scenario_id),
+        'raster_uuid': raster_uuid,
+        'parameters': parameters
+    }
+    return sha1(json.dumps(key, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+
+
+def count(library, outcome):
+    """ Count a cache hit or miss for a library. """
+    cache = counters_cache()
+    key = 'stsim-result-cache:{}:{}'.format(library, outcome)
+    cache.add(key, 0, None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, 1, None)     # evicted between the add and the incr
+
+
+def counters(library):
+    """ Hits and misses of the result cache for a library. """
+    cache = counters_cache()
+    return {outcome: cache.get('stsim-result-cache:{}:{}'.format(library, outcome), 0)
+            for outcome in ('hits', 'misses')}
+
+
+def cached_run(library, run_hash):
+    """
+    The latest completed run with the same parameters hash, if its results are still available.
+    Counts the lookup as a hit or a miss.
+    """
+    oldest = timezone.now() - timedelta(seconds=RESULT_CACHE_AGE)
+    model_run = STSimModelRun.objects.filter(library=library, parameters_hash=run_hash, created__gte=oldest) \
+        .exclude(result_scenario_id=-1).order_by('-pk').first()
+
+    # completed runs keep their results and spatial outputs out of the working copy, except for runs
+    # that never stored them, whose results are gone once their working copy was recycled
+    if model_run is not None and len(model_run.results) == 0:
+        console_pool = stsim_manager.console_pools[library]
+        if model_run.created.timestamp() < console_pool.recycled_at(model_run.console_slot):
+            model_run = None
+
+    count(library, 'hits' if model_run is not None else 'misses')
+    return model_run
+
+
+def evict(library):
+    """ Stop offering completed runs of a library for reuse once they are too old or too many. """
+    oldest = timezone.now() - timedelta(seconds=RESULT_CACHE_AGE)
+    memoized = STSimModelRun.objects.filter(library=library).exclude(parameters_hash='').exclude(result_scenario_id=-1)
+    memoized.filter(created__lt=oldest).update(parameters_hash='')
+    kept = memoized.order_by('-pk').values_list('pk', flat=True)[:RESULT_CACHE_SIZE]
+    memoized.exclude(pk__in=list(kept)).update(parameters_hash='')
@@ -0,0 +1,65 @@
+"""
+    Scheduling of model runs on the celery workers.
+
+    Runs are routed by their estimated cost, cells x timesteps x iterations, so
+    large runs and batches queue separately from the quick runs users sit and
+    wait on. Every run gets a deadline to start by and a time limit to finish
+    in, and libraries turn new runs away once too many of theirs are waiting.
+"""
+
+from datetime import timedelta
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from .models import STSimModelRun
+
+# Queue of the quick runs interactive users wait on; the default celery queue, so existing workers serve it
+INTERACTIVE_QUEUE = getattr(settings, 'STSIM_INTERACTIVE_QUEUE', 'celery')
+
+# Queue of the expensive runs and of batches. Every worker consumes it unless started with -Q, see the README
+BATCH_QUEUE = getattr(settings, 'STSIM_BATCH_QUEUE', 'stsim_batch')
+
+# Runs costing more than this go to the batch queue
+BATCH_COST = getattr(settings, 'STSIM_BATCH_COST', 10 ** 7)
+
+# Seconds a run may wait in each queue before it is dropped
+QUEUE_DEADLINES = getattr(settings, 'STSIM_QUEUE_DEADLINES', {INTERACTIVE_QUEUE: 10 * 60, BATCH_QUEUE: 6 * 60 * 60})
+
+# Seconds a run may take in each queue before it is stopped
+RUN_TIME_LIMITS = getattr(settings, 'STSIM_RUN_TIME_LIMITS', {INTERACTIVE_QUEUE: 30 * 60, BATCH_QUEUE: 12 * 60 * 60})
+
+# Most runs of a library that may be queued or running at once, before new ones are turned away
+MAX_PENDING_RUNS = getattr(settings, 'STSIM_MAX_PENDING_RUNS', 50)
+
+
+def run_cost(parameters):
+    """ Estimated cost of a run, in cell timesteps. """
+    return parameters['total_active_cells'] * (parameters['timesteps'] + 1) * parameters['iterations']
+
+
+def run_queue(parameters, batch=False):
+    """ The queue a run goes to, by its cost, or the batch queue for members of a batch. """
+    return BATCH_QUEUE if batch or run_cost(parameters) > BATCH_COST else INTERACTIVE_QUEUE
+
+
+def deadline(queue):
+    """ When a run queued now must have started by. """
+    return timezone.now() + timedelta(seconds=QUEUE_DEADLINES[queue])
+
+
+def pending_runs(library):
+    """
+    Runs of a library that are queued or running, not counting the batches and sharded runs above them.
+    Runs whose worker died never record their end, so they stop counting once they are past any time limit.
+    """
+    now = timezone.now()
+    started_since = now - timedelta(seconds=max(RUN_TIME_LIMITS.values()) + 60)
+    return STSimModelRun.objects.filter(library=library, result_scenario_id=-1, cancelled=False, failure='',
+                                        members__isnull=True) \
+        .filter(Q(dequeued_at__gte=started_since) | Q(dequeued_at__isnull=True, deadline__gte=now)) \
+        .exclude(parameters='').count()
+
+
+def admit(library, runs=1):
+    """ Whether a library can take on more runs right now. """
+    return pending_runs(library) + runs <= MAX_PENDING_RUNS
@@ -220,17 +220,35 @@ function run_st_sim(feature_id) {
             var model_run_id = model_run_reponse["model_run_id"];
             var total_cells = model_run_reponse["total_cells"];
             var total_active_cells = model_run_reponse["total_active_cells"];
+            var run_state = 'running';
+
+            // results so far, along with a way to stop the run
+            function show_progress(progress) {
+                $("#results_loading").html("<img src='/static/img/spinner.gif'> " + progress.toFixed(0) + "% " +
+                    "<a href='#' id='cancel_run_link'>Cancel</a>");
+                $("#cancel_run_link").click(function (e) {
+                    e.preventDefault();
+                    $(this).remove();
+                    $.post(settings['library'] + '/run_st_sim/' + current_uuid + '/cancel/', {'model_run_id': model_run_id});
+                });
+            }
+            show_progress(0);
 
-            (function poll(){
+            (function poll(delay){
                 setTimeout(function(){
-                    $.getJSON(settings['library'] + '/run_st_sim/' + current_uuid + '/done/',
+                    // held open by the server until there is news about the run, so ask again right away
+                    $.getJSON(settings['library'] + '/run_st_sim/' + current_uuid + '/wait/',
                         {
                             'model_run_id': model_run_id,
+                            'state': run_state,
                             'total_cells': total_cells,
                             'total_active_cells': total_active_cells
                         }).done(
                         function(res) {
                             var status = res['status'];
+                            if (status != 'running') {
+                                $("#area_charts_partial").empty()
+                            }
                             if (status == 'complete') {
                                 $("#results_loading").empty()
                                 var response = res;
@@ -263,15 +281,27 @@ function run_st_sim(feature_id) {
                                     'step_size': 1,
                                     'iterations': settings['iterations'],
                                     'spatial': settings['spatial'],
-                                    'result_scenario_id': JSON.parse(response["result_scenario_id"])
+                                    'result_scenario_id': JSON.parse(response["result_scenario_id"]),
+                                    'model_run_id': model_run_id
                                 };
                                 //landscape_viewer.collectSpatialOutputs(run_control);
+                            } else if (status == 'running') {
+                                run_state = res['state'];
+                                if (res['progress'] !== undefined) {
+                                    show_progress(res['progress'])
+                                }
+                                if (res['partial_results_json'] !== undefined) {
+                                    create_area_charts(res['partial_results_json'], 'partial')
+                                }
+                                poll((res['poll_after'] || 0) * 1000);   // held open by the server, unless it can't wait
                             } else {
-                                poll();
+                                $("#results_loading").empty()   // cancelled, failed, timed out or expired in the queue
                             }
+                        }).fail(function() {
+                            poll(20000);    // back off while the server is unreachable
                         })
-                }, 20000);  // check every 20 seconds
-            })();
+                }, delay);
+            })(0);
 
 
 
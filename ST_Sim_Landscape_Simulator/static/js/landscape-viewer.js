@@ -740,7 +740,7 @@ define("app", ["require", "exports", "terrain", "utils", "assetloader"], functio
             if (!runControl.spatial)
                 return;
             const sid = runControl.result_scenario_id;
-            const srcSpatialTexturePath = runControl.library + '/outputs/' + sid;
+            const srcSpatialTexturePath = runControl.library + '/outputs/' + runControl.model_run_id;
             let model_outputs = new Array();
             for (var step = runControl.min_step; step <= runControl.max_step; step += runControl.step_size) {
                 for (var it = 1; it <= runControl.iterations; it += 1) {
@@ -495,7 +495,7 @@ export default function run(container_id: string, showloadingScreen: Function, h
 		if (!runControl.spatial) return
 		
 		const sid = runControl.result_scenario_id
-		const srcSpatialTexturePath = runControl.library + '/outputs/' + sid
+		const srcSpatialTexturePath = runControl.library + '/outputs/' + runControl.model_run_id
 
 		let model_outputs : AssetDescription[] = new Array()
 		for (var step = runControl.min_step; step <= runControl.max_step; step += runControl.step_size) {
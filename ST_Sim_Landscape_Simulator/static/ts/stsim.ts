@@ -9,6 +9,7 @@ export interface RunControl {
 	iterations : number
 	spatial: boolean
 	result_scenario_id: number
+	model_run_id: number
 }
 
 export interface DefinitionMapping {
@@ -1,15 +1,386 @@
-from celery import shared_task
+import os
+import json
+import time
+import shutil
+from uuid import uuid4
+from celery import shared_task, chain, chord, group, current_app
+from celery.exceptions import Ignore, SoftTimeLimitExceeded
+from django.conf import settings
+from django.utils import timezone
+from stsimpy import cells_to_acres
+from OutputProcessing import texture_utils, selections
 from .models import STSimModelRun
-from Sagebrush.stsim_utils import stsim_manager
+from . import notifications, scheduling
+from .progress import ProgressMonitor
+from collections import OrderedDict
+from Sagebrush.stsim_utils import stsim_manager, normalize_summary, stop_console_processes, CONSOLE_ACQUIRE_TIMEOUT
+
+
+# Split non-spatial runs with more iterations than this into shards run in parallel, 0 to never split runs
+SHARD_ITERATIONS = getattr(settings, 'STSIM_SHARD_ITERATIONS', 0)
+
+
+def shard_iterations(iterations, shard_size):
+    """ Split iterations 1..iterations into (first_iteration, iterations) shards of at most shard_size. """
+    return [(first, min(shard_size, iterations - first + 1)) for first in range(1, iterations + 1, shard_size)]
+
+
+def run_chain(model_run, queue):
+    """ Prepare, run and export one run on a queue, by its deadline and within its time limit. """
+    prepare_task_id = str(uuid4())     # known up front, so the run can be cancelled while it is queued
+    time_limit = scheduling.RUN_TIME_LIMITS[queue]
+    model_run.deadline = scheduling.deadline(queue)
+    model_run.task_id = prepare_task_id
+    STSimModelRun.objects.filter(pk=model_run.pk).update(deadline=model_run.deadline, task_id=prepare_task_id)
+    return chain(prepare_stsim.s(model_run.pk).set(queue=queue, task_id=prepare_task_id, expires=model_run.deadline),
+                 run_stsim.s().set(queue=queue, soft_time_limit=time_limit, time_limit=time_limit + 60),
+                 export_stsim.s().set(queue=queue))
+
+
+def model_run_pipeline(model_run_id, batch=False):
+    """
+    The whole pipeline of a model run: prepare the inputs, run the model and export the results.
+    Large non-spatial runs are split into shards of iterations, each run in its own working copy,
+    and merged back into one result.
+    :param model_run_id: The model run
+    :param batch: Whether the run is part of a batch, which always goes to the batch queue
+    """
+    model_run = STSimModelRun.objects.get(pk=model_run_id)
+    model_run.mark('enqueued')
+    parameters = json.loads(model_run.parameters)
+    queue = scheduling.run_queue(parameters, batch)
+    if SHARD_ITERATIONS <= 0 or parameters['is_spatial'] or parameters['iterations'] <= SHARD_ITERATIONS:
+        return run_chain(model_run, queue)
+
+    shards = list()
+    for first_iteration, iterations in shard_iterations(parameters['iterations'], SHARD_ITERATIONS):
+        shard_parameters = dict(parameters, iterations=iterations, first_iteration=first_iteration)
+        shards.append(STSimModelRun.objects.create(
+            scenario_id=model_run.scenario_id, raster_uuid=model_run.raster_uuid, library=model_run.library,
+            parameters=json.dumps(shard_parameters), parent=model_run,
+            enqueued_at=model_run.enqueued_at, **STSimModelRun.size_fields(shard_parameters)))
+    return chord(group(run_chain(shard, queue) for shard in shards),
+                 merge_shards.s(model_run_id).set(queue=queue))
+
+
+def start_model_run(model_run_id):
+    return model_run_pipeline(model_run_id).delay()
+
+
+def start_batch(batch_id, model_run_ids):
+    """ Fan the member runs of a batch out across the workers, and aggregate their results once all are done. """
+    if len(model_run_ids) == 0:
+        return finish_batch.apply_async(([], batch_id), queue=scheduling.BATCH_QUEUE)
+    return chord(group(model_run_pipeline(model_run_id, batch=True) for model_run_id in model_run_ids),
+                 finish_batch.s(batch_id).set(queue=scheduling.BATCH_QUEUE)).delay()
+
+
+def report_file(model_run):
+    """ Where the console writes the stateclass summary of a run, unique across the working copies. """
+    return os.path.join(settings.STSIM_WORKING_DIR, "model_results",
+                        "stateclass-summary-{}-{}-{}.csv".format(model_run.library, model_run.console_slot,
+                                                                 model_run.result_scenario_id))
+
+
+def stored_summary(model_run):
+    """
+    The stateclass summary of a completed run, as fractions of the simulated cells.
+    It is exported from the working copy once and stored on the run, so reading it again is a single row lookup.
+    """
+    if len(model_run.results) == 0:
+        summary = stsim_manager.stateclass_summary(model_run.library, model_run.result_scenario_id,
+                                                   report_file(model_run), norm=1.0, slot=model_run.console_slot)
+        model_run.results = json.dumps(summary, separators=(',', ':'))
+        model_run.save(update_fields=['results'])
+    return json.loads(model_run.results)
+
+
+def exported_summary(model_run, norm=1.0):
+    """ The stateclass summary of a completed run, scaled by a normalization factor. """
+    return normalize_summary(stored_summary(model_run), norm)
+
+
+def run_summary(model_run):
+    """ The stateclass summary of a completed run, normalized to the whole landscape. """
+    parameters = json.loads(model_run.parameters)
+    return exported_summary(model_run, norm=parameters['total_active_cells'] / parameters['total_cells'])
+
+
+def prepare_inputs(console, library, scenario_id, raster_uuid, parameters):
+    """
+    Write the inputs of a model run into the scenario of a checked out working copy.
+    :param console: The console of the working copy
+    :param library: Name of the library in the STSIM_CONFIG
+    :param scenario_id: The scenario to prepare
+    :param raster_uuid: The selection id, or 'predefined-extent'
+    :param parameters: The parameters stored on the model run
+    """
+
+    step = 1
+    min_step = 0
+    max_step = parameters['timesteps']
+    is_spatial = parameters['is_spatial']
+
+    # working file path
+    init_conditions_file = os.path.join(settings.STSIM_WORKING_DIR,
+                                        "initial_conditions",
+                                        "user_defined_temp" + str(time.time()) + ".csv")
+
+    # set the run control for the spatial model
+    console.update_run_control(
+        sid=scenario_id, working_path=init_conditions_file,
+        spatial=is_spatial, iterations=parameters['iterations'], start_timestep=min_step, end_timestep=max_step
+    )
+
+    output_settings = {
+        'SummaryOutputSC': True,
+        'SummaryOutputSCTimesteps': step,
+        'SummaryOutputTR': True,
+        'SummaryOutputTRTimesteps': step
+    }
+
+    if is_spatial:
+
+        output_settings['RasterOutputSC'] = True
+        output_settings['RasterOutputSCTimesteps'] = step
+
+        if not stsim_manager.has_predefined_extent[library]:
+
+            # write out the selected vegtype, stateclass rasters (converted if necessary) for stsim
+            selection_paths = selections.materialize_selection(library, raster_uuid)
+            if selection_paths is None:
+                raise ValueError('Selection ' + raster_uuid + ' of ' + library + ' no longer exists.')
+            veg_path, sc_path = selection_paths
+            selections.evict_selections(library, keep=STSimModelRun.running_selections() | {raster_uuid})
+
+            # import vegtype, stateclass raster into stsim
+            console.import_spatial_initial_conditions(sid=scenario_id, working_path=init_conditions_file,
+                                                      strata_path=veg_path, sc_path=sc_path)
+    else:
+        total_active_cells = parameters['total_active_cells']
+        console.import_nonspatial_conditions(
+            scenario_id,
+            {'TotalAmount': str(cells_to_acres(total_active_cells,
+                                               selections.cell_resolution(library, raster_uuid))),
+             'NumCells': str(total_active_cells),
+             'CalcFromDist': ''},   # Distribution seems off, since we would need to set the number of acres per vegtype.
+            init_conditions_file)
+        console.import_nonspatial_distribution(scenario_id,
+                                               parameters['stateclass_relative_distribution'],
+                                               init_conditions_file)
+
+    # update the output options for the step size
+    console.set_output_options(scenario_id, init_conditions_file, **output_settings)
+
+    # probabilistic transition probabilities, adjusted by the user's modifiers for the ST-Sim working library
+    probabilities = stsim_manager.original_transitions(library, scenario_id, init_conditions_file, console) \
+        .modified(parameters['probabilistic_transitions_modifiers'])
+
+    console.import_probabilistic_transitions(scenario_id,
+                                             probabilities,
+                                             init_conditions_file)
+
+    transition_targets = parameters['transition_targets']
+    if len(transition_targets.keys()) > 0:
+        console.import_transition_targets(scenario_id,
+                                          init_conditions_file,
+                                          transition_targets)
+
+
+def release_console(model_run):
+    """ Hand the working copy of a run to the next run. """
+    stsim_manager.console_pools[model_run.library].release(model_run.console_slot, model_run.lease_token)
+    model_run.holds_console = False
+    STSimModelRun.objects.filter(pk=model_run.pk).update(holds_console=False)
+
+
+def fail_run(model_run, failure):
+    """
+    Record that a run broke off, and tell the clients waiting on it. A failed shard fails the run it's part of.
+    :param model_run: The model run
+    :param failure: 'failed', 'timed_out' if the run ran out of time, or 'expired' if it never got to run
+    """
+    failed = [model_run.pk]
+    if model_run.parent_id is not None and 'first_iteration' in json.loads(model_run.parameters):
+        failed.append(model_run.parent_id)
+    STSimModelRun.objects.filter(pk__in=failed).update(failure=failure)
+    for model_run_id in failed:
+        notifications.publish(model_run_id, failure)
+
+
+def stop_if_cancelled(model_run):
+    """
+    Stop the task working on a run if the run was cancelled, returning its working copy.
+    Only tasks return working copies, once no console is running in them any more.
+    """
+    if STSimModelRun.objects.filter(pk=model_run.pk, cancelled=True).exists():
+        if model_run.holds_console:
+            release_console(model_run)
+        notifications.publish(model_run.pk, 'cancelled')
+        raise Ignore()
+
+
+def start_task(task, model_run_id):
+    """
+    Load the run a task works on and record the task on it, so the run can be cancelled.
+    A run that was cancelled in the meantime stops here, returning its working copy.
+    """
+    model_run = STSimModelRun.objects.get(pk=model_run_id)
+    stop_if_cancelled(model_run)
+    model_run.task_id = task.request.id or ''
+    model_run.worker = task.request.hostname or ''
+    STSimModelRun.objects.filter(pk=model_run_id).update(task_id=model_run.task_id, worker=model_run.worker)
+    return model_run
+
+
+def cancel_run(model_run):
+    """
+    Cancel a run and the runs under it. Queued tasks are revoked; a running model is stopped by the
+    worker running it, which returns the working copy once the console exited.
+    """
+    for member in model_run.members.all():
+        cancel_run(member)
+    if model_run.result_scenario_id != -1 and model_run.members.count() == 0:
+        return   # already complete
+    STSimModelRun.objects.filter(pk=model_run.pk).update(cancelled=True)
+    if len(model_run.task_id) > 0:
+        current_app.control.revoke(model_run.task_id)
+    notifications.publish(model_run.pk, 'cancelled')
+
+
+@shared_task(bind=True, max_retries=None)
+def prepare_stsim(self, model_run_id):
+    model_run = start_task(self, model_run_id)
+    console_pool = stsim_manager.console_pools[model_run.library]
+
+    # check out a working copy of the library, returned by the export once the results are out
+    try:
+        console_slot, lease_token = console_pool.acquire(timeout=CONSOLE_ACQUIRE_TIMEOUT)
+    except TimeoutError as e:
+        if model_run.deadline is not None and model_run.deadline <= timezone.now():
+            fail_run(model_run, 'expired')     # a retry would only be dropped unseen once it expires
+            raise Ignore()
+        raise self.retry(exc=e, countdown=5)
+
+    # the run is only off the queue once it has a working copy to run in
+    model_run.mark('dequeued')
+
+    try:
+        model_run.console_slot = console_slot
+        model_run.lease_token = lease_token
+        model_run.holds_console = True
+        model_run.save(update_fields=['console_slot', 'lease_token', 'holds_console'])
+        with console_pool.keep_lease(console_slot, lease_token):
+            prepare_inputs(console_pool.console(console_slot), model_run.library, model_run.scenario_id,
+                           model_run.raster_uuid, json.loads(model_run.parameters))
+    except Exception:
+        release_console(model_run)
+        fail_run(model_run, 'failed')
+        raise
+    model_run.mark('prepared')
+    return model_run_id
+
+
+@shared_task(bind=True)
+def run_stsim(self, model_run_id):
+    model_run = start_task(self, model_run_id)
+    console_pool = stsim_manager.console_pools[model_run.library]
+    monitor = ProgressMonitor(model_run, console_pool.library(model_run.console_slot))
+    monitor.start()
+    model_run.mark('started')
+    try:
+        with console_pool.keep_lease(model_run.console_slot, model_run.lease_token):
+            r_sid = int(console_pool.console(model_run.console_slot).run_model(model_run.scenario_id))
+    except SoftTimeLimitExceeded:
+        # the console is still running, and has to be gone before anyone else gets the working copy
+        stop_console_processes(reap=True)
+        release_console(model_run)
+        fail_run(model_run, 'timed_out')
+        raise
+    except Exception:
+        release_console(model_run)
+        stop_if_cancelled(model_run)
+        fail_run(model_run, 'failed')
+        raise
+    finally:
+        monitor.stop()
+    stop_if_cancelled(model_run)    # the console may have finished just as it was stopped
+    model_run.mark('finished')
+    print('Model run complete')
+    return model_run_id, r_sid
+
+
+@shared_task(bind=True)
+def export_stsim(self, run):
+    model_run_id, r_sid = run
+    model_run = start_task(self, model_run_id)
+    console_pool = stsim_manager.console_pools[model_run.library]
+    try:
+        with console_pool.keep_lease(model_run.console_slot, model_run.lease_token):
+            if json.loads(model_run.parameters)['is_spatial']:
+                # process each output raster in the output directory, and keep them with the run,
+                # as the working copy's outputs go when the slot is recycled
+                spatial_directory = os.path.join(console_pool.slot_path(model_run.console_slot) + '.output',
+                                                 'Scenario-' + str(r_sid), 'Spatial')
+                texture_utils.process_stateclass_directory(
+                    dir_path=spatial_directory,
+                    sc_defs=stsim_manager.stateclass_definitions[model_run.library]
+                )
+                shutil.rmtree(model_run.output_directory(), ignore_errors=True)
+                os.makedirs(os.path.dirname(model_run.output_directory()), exist_ok=True)
+                shutil.move(spatial_directory, model_run.output_directory())
+            model_run.result_scenario_id = r_sid
+            model_run.progress = 100.0
+            model_run.partial_results = ''
+            stored_summary(model_run)   # export the summary once, for every status poll to read
+            model_run.save(update_fields=['result_scenario_id', 'progress', 'partial_results'])
+    except Exception:
+        fail_run(model_run, 'failed')
+        raise
+    finally:
+        release_console(model_run)
+    model_run.mark('exported')
+    notifications.publish(model_run_id, 'complete')
+    return model_run_id
+
+
+def batch_results(batch):
+    """ The results of the completed member runs of a batch. """
+    results = list()
+    for model_run in batch.members.exclude(result_scenario_id=-1).order_by('pk'):
+        results.append({
+            'model_run_id': model_run.pk,
+            'parameters': json.loads(model_run.parameters),
+            'result_scenario_id': model_run.result_scenario_id,
+            'results_json': run_summary(model_run)
+        })
+    return results
 
 
 @shared_task
-def run_stsim(library, model_run_id, scenario_id):
-    #r_sid = console.run_model(scenario_id)
-    console = stsim_manager.consoles[library]
-    r_sid = int(console.run_model(scenario_id))
-    #r_sid = 1234    # test_values
+def finish_batch(model_run_ids, batch_id):
+    batch = STSimModelRun.objects.get(pk=batch_id)
+    results = batch_results(batch)
+    batch.results = json.dumps(results)
+    batch.save()
+    notifications.publish(batch_id, 'complete')
+    return batch_id
+
+
+@shared_task
+def merge_shards(model_run_ids, model_run_id):
+    """ Merge the summaries of the shards of a run into its results, numbering iterations across the shards. """
     model_run = STSimModelRun.objects.get(pk=model_run_id)
-    model_run.result_scenario_id = r_sid
+    shards = list(model_run.members.order_by('pk'))
+    merged = OrderedDict()
+    for shard in shards:
+        offset = json.loads(shard.parameters)['first_iteration'] - 1
+        for iteration, timesteps in exported_summary(shard).items():
+            merged[str(int(iteration) + offset)] = timesteps
+    model_run.results = json.dumps(merged, separators=(',', ':'))
+    model_run.console_slot = shards[0].console_slot
+    model_run.result_scenario_id = shards[0].result_scenario_id
     model_run.save()
-    print('Model run complete')
+    model_run.mark('exported')
+    notifications.publish(model_run_id, 'complete')
+    return model_run_id
@@ -5,7 +5,15 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
-from django.test import TestCase
+import os
+import tempfile
+import numpy as np
+import rasterio
+from unittest import mock
+from django.test import SimpleTestCase, TestCase
+from Management.commands import build_converted_stateclass
+from OutputProcessing.plugins import conversions
+from Sagebrush.stsim_utils import stsim_manager
 
 
 class SimpleTest(TestCase):
@@ -14,3 +22,60 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+def copy_stateclasses(veg_data, sc_data):
+    return sc_data
+
+
+class ConvertedStateclassTest(SimpleTestCase):
+    """
+    The library-wide converted stateclass raster is used once it's built, and only while it's current.
+    """
+
+    lib = 'Tiny'
+
+    def setUp(self):
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.veg_path = os.path.join(self.directory.name, 'veg.tif')
+        self.sc_path = os.path.join(self.directory.name, 'sc.tif')
+        self.output_path = os.path.join(self.directory.name, 'sc-converted.tif')
+        desc_path = os.path.join(self.directory.name, 'descriptions.csv')
+
+        profile = {'driver': 'GTiff', 'width': 4, 'height': 4, 'count': 1, 'dtype': 'uint8'}
+        for path, value in ((self.veg_path, 1), (self.sc_path, 2)):
+            with rasterio.open(path, 'w', **profile) as dst:
+                dst.write(np.full((4, 4), value, dtype='uint8'), 1)
+        with open(desc_path, 'w') as f:
+            f.write('code\n')
+
+        patches = [
+            mock.patch.dict(conversions.array_conversions, {'copy_stateclasses': copy_stateclasses}),
+            mock.patch.object(stsim_manager, 'library_names', stsim_manager.library_names + [self.lib]),
+            mock.patch.dict(stsim_manager.conversion_functions, {self.lib: 'copy_stateclasses'}),
+            mock.patch.dict(stsim_manager.veg_paths, {self.lib: self.veg_path}),
+            mock.patch.dict(stsim_manager.sc_paths, {self.lib: self.sc_path}),
+            mock.patch.dict(stsim_manager.desc_file_path, {self.lib: desc_path}),
+            mock.patch.dict(stsim_manager.converted_sc_paths, {self.lib: self.output_path}),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.addCleanup(conversions.forget_converted_stateclass, self.lib)
+
+    def test_not_built(self):
+        self.assertIsNone(conversions.converted_stateclass_path(self.lib))
+
+    def test_built(self):
+        self.assertEqual(build_converted_stateclass(self.lib, processes=1), self.output_path)
+        self.assertEqual(conversions.converted_stateclass_path(self.lib), self.output_path)
+        # served from the memo the second time
+        self.assertEqual(conversions.converted_stateclass_path(self.lib), self.output_path)
+
+    def test_stale(self):
+        build_converted_stateclass(self.lib, processes=1)
+        stat = os.stat(self.sc_path)
+        os.utime(self.sc_path, (stat.st_atime, stat.st_mtime + 10))
+        self.assertIsNone(conversions.converted_stateclass_path(self.lib))
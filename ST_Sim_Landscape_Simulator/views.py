@@ -1,19 +1,17 @@
 import os
 import json
-import time
 from django.views.generic import TemplateView, View
 from django.conf import settings
 from json import encoder
-from django.http import HttpResponse, JsonResponse, HttpResponseNotFound
+from django.http import HttpResponse, JsonResponse, HttpResponseNotFound, HttpResponseBadRequest, FileResponse
 from PIL import Image
-from OutputProcessing import texture_utils, raster_utils
-from OutputProcessing.plugins import lookups, conversions
-from Heightmaps.plugins import heights
-from Sagebrush.stsim_utils import stsim_manager
-from stsimpy import cells_to_acres
-from uuid import uuid4
-from ST_Sim_Landscape_Simulator.tasks import run_stsim
+from OutputProcessing import texture_utils, selections
+from OutputProcessing.plugins import lookups
+from Sagebrush.stsim_utils import stsim_manager, normalize_summary
+from ST_Sim_Landscape_Simulator.tasks import start_model_run, start_batch, stored_summary, exported_summary, \
+    cancel_run, batch_results
 from .models import STSimModelRun
+from . import result_cache, notifications, progress, metrics, scheduling
 
 # Two decimal places when dumping to JSON
 encoder.FLOAT_REPR = lambda o: format(o, '.2f')
@@ -37,7 +35,6 @@ class RasterSelectionView(View):
 
     def __init__(self):
         self.library = None
-        self.stsim = None
         self.left = None
         self.bottom = None
         self.right = None
@@ -49,7 +46,6 @@ class RasterSelectionView(View):
         self.library = kwargs.get('library')
         if self.library not in stsim_manager.library_names:
             return HttpResponseNotFound()
-        self.stsim = stsim_manager.consoles[self.library]
         self.left = float(kwargs.get('left'))
         self.bottom = float(kwargs.get('bottom'))
         self.right = float(kwargs.get('right'))
@@ -59,30 +55,11 @@ class RasterSelectionView(View):
 
     def get(self, request, *args, **kwargs):
 
-        raster_uuid = str(uuid4())
-        elev_path = os.path.join(self.output_path, raster_uuid + '-elev.tif')
-        sc_path = os.path.join(self.output_path, raster_uuid + '-sc.tif')
-        veg_path = os.path.join(self.output_path, raster_uuid + '-veg.tif')
-
         if stsim_manager.has_predefined_extent[self.library]:
             return JsonResponse({'uuid': 'predefined-extent'})
 
-        raster_utils.clip_from_wgs(stsim_manager.elev_paths[self.library],
-                                   elev_path,
-                                   (self.left, self.bottom, self.right, self.top))
-        raster_utils.clip_from_wgs(stsim_manager.sc_paths[self.library],
-                                   sc_path,
-                                   (self.left, self.bottom, self.right, self.top))
-        raster_utils.clip_from_wgs(stsim_manager.veg_paths[self.library],
-                                   veg_path,
-                                   (self.left, self.bottom, self.right, self.top))
-
-        if stsim_manager.has_lookup_fields[self.library]:
-            sc_conversion_func = getattr(conversions, stsim_manager.conversion_functions[self.library])
-            sc_conversion_path = os.path.join(self.output_path, raster_uuid + '-' +
-                                              stsim_manager.conversion_extensions[self.library] + '.tif')
-            sc_conversion_func(veg_path, sc_path, sc_conversion_path)
-
+        raster_uuid = selections.select(self.library, (self.left, self.bottom, self.right, self.top))
+        selections.evict_selections(self.library, keep=STSimModelRun.running_selections() | {raster_uuid})
         return JsonResponse({'uuid': raster_uuid})
 
 
@@ -122,31 +99,11 @@ class RasterTextureView(RasterTextureBase):
 
     def get(self, request, *args, **kwargs):
 
-        response = HttpResponse(content_type="image/png")
-
-        ext = self.type if self.type != 'sc' else ('sc' if not stsim_manager.has_lookup_fields[self.library] else stsim_manager.conversion_extensions[self.library])
-        if self.raster_uuid == 'predefined-extent':
-            path = getattr(stsim_manager, self.type + '_paths')[self.library]
-        else:
-            path = os.path.join(self.output_path, self.raster_uuid + '-' + ext + '.tif')
-
-        if self.type == 'elev':
-            if stsim_manager.has_predefined_extent[self.library]:
-                elev_func = getattr(heights, stsim_manager.heightmap_functions[self.library])
-                elev_path = stsim_manager.elev_paths[self.library]
-                texture = elev_func(elev_path)
-            else:
-                texture = texture_utils.elevation_texture(path)
-        elif self.type == 'sc':
-            sc_colormap = texture_utils.create_colormap(stsim_manager.stateclass_definitions[self.library])
-            texture = texture_utils.stateclass_texture(path, sc_colormap)
-        elif self.type == 'veg':
-            texture = texture_utils.vegtype_texture(path, veg_defs=stsim_manager.vegtype_definitions[self.library])
-        else:
+        products = selections.selection_products(self.library, self.raster_uuid)
+        if products is None:
             return HttpResponseNotFound()
 
-        texture.save(response, 'PNG')
-        return response
+        return HttpResponse(products['textures'][self.type], content_type="image/png")
 
 
 class RasterTextureStats(RasterTextureBase):
@@ -156,53 +113,11 @@ class RasterTextureStats(RasterTextureBase):
 
     def get(self, request, *args, **kwargs):
 
-        if self.raster_uuid == 'predefined-extent' and stsim_manager.has_predefined_extent[self.library]:
-            elev_path = stsim_manager.elev_paths[self.library]
-            sc_path = stsim_manager.sc_paths[self.library]
-            veg_path = stsim_manager.veg_paths[self.library]
-        elif self.raster_uuid != 'predefined-extent' and stsim_manager.has_predefined_extent[self.library] \
-                or self.raster_uuid == 'predefined-extent' and not stsim_manager.has_predefined_extent[self.library]:
+        products = selections.selection_products(self.library, self.raster_uuid)
+        if products is None:
             return HttpResponseNotFound()
-        else:   # raster_uuid is a uuid and the library is boundless
-            sc_ext = 'sc' if not stsim_manager.has_lookup_fields[self.library] else stsim_manager.conversion_extensions[self.library]
-            sc_path = os.path.join(self.output_path, self.raster_uuid + '-' + sc_ext + '.tif')
-            elev_path = os.path.join(self.output_path, self.raster_uuid + '-elev.tif')
-            veg_path = os.path.join(self.output_path, self.raster_uuid + '-veg.tif')
-
-        # elevation information
-        elev_stats = raster_utils.elevation_stats(elev_path)
-
-        # determine vegetation initial coverage by state class
-        veg_state_defs = stsim_manager.all_veg_state_classes[self.library]
-        vegtype_defs = stsim_manager.vegtype_definitions[self.library]
-        stateclass_defs = stsim_manager.stateclass_definitions[self.library]
-        veg_sc_pcts, veg_total, sc_total = raster_utils.zonal_stateclass_stats(veg_path, sc_path, stateclass_defs)
-
-        zonal_veg_sc_pcts = dict()
-        for vegtype in veg_state_defs.keys():
-            veg_id = int(vegtype_defs[vegtype]['ID'])
-            if veg_id in veg_sc_pcts.keys():
-                zonal_veg = dict()
-                for sc_type in veg_state_defs[vegtype]:
-                    sc_id = int(stateclass_defs[sc_type]['ID'])
-                    if sc_id in veg_sc_pcts[veg_id].keys():
-                        zonal_veg[sc_type] = veg_sc_pcts[veg_id][sc_id]
-                    else:
-                        zonal_veg[sc_type] = 0
-                zonal_veg_sc_pcts[vegtype] = zonal_veg
-
-        veg_codes = zonal_veg_sc_pcts.keys()
-        if stsim_manager.has_lookup_fields[self.library]:
-            lookup_function = getattr(lookups, stsim_manager.lookup_functions[self.library])
-            veg_names = lookup_function(veg_codes, stsim_manager.lookup_fields[self.library][0])
-        else:
-            veg_names = {name: name for name in veg_codes}
 
-        return JsonResponse({'elev': elev_stats,
-                             'veg_sc_pct': zonal_veg_sc_pcts,
-                             'veg_names': veg_names,
-                             'total_cells': veg_total,
-                             'total_active_cells': sc_total})
+        return JsonResponse(products['stats'])
 
 
 class RasterTileBase(View):
@@ -224,6 +139,20 @@ class RasterTileBase(View):
         return super().dispatch(request, *args, **kwargs)
 
 
+def png_file_response(path):
+    """
+    Stream a PNG stored on disk as it is, without decoding it, so the server can hand the file to sendfile.
+    :param path: Path to the PNG
+    """
+    try:
+        png = open(path, 'rb')
+    except FileNotFoundError:
+        return HttpResponseNotFound()
+    response = FileResponse(png, content_type='image/png')
+    response['Content-Length'] = os.fstat(png.fileno()).st_size
+    return response
+
+
 class RasterTileView(RasterTileBase):
 
     data_types = ['elev', 'veg', 'sc']
@@ -248,13 +177,7 @@ class RasterTileView(RasterTileBase):
             stsim_manager.tile_directory[self.library], self.library,
             self.reporting_unit, self.unit_id, self.type, self.tile_name)
 
-        if not os.path.exists(texture_path):
-            return HttpResponseNotFound()
-
-        image = Image.open(texture_path)
-        response = HttpResponse(content_type="image/png")
-        image.save(response, 'PNG')
-        return response
+        return png_file_response(texture_path)
 
 
 class RasterTileStats(RasterTileBase):
@@ -300,7 +223,6 @@ class STSimBaseView(View):
 
     def __init__(self):
         self.library = None
-        self.stsim = None
         self.project_id = None
         self.scenario_id = None
         self.output_path = None
@@ -310,7 +232,6 @@ class STSimBaseView(View):
         self.library = kwargs.get('library')
         if self.library not in stsim_manager.library_names:
             return HttpResponseNotFound()
-        self.stsim = stsim_manager.consoles[self.library]
         self.project_id = stsim_manager.pids[self.library]
         self.output_path = stsim_manager.output_paths[self.library]
         if 'scenario_id' in kwargs:
@@ -392,6 +313,58 @@ class LibraryInfoView(STSimBaseView):
         return JsonResponse(response)
 
 
+def too_busy():
+    """ Turn a run away while its library has too many runs waiting. """
+    response = HttpResponse(status=503)
+    response['Retry-After'] = '60'
+    return response
+
+
+def decoded(value):
+    """ Run settings are posted as json strings, but come already decoded inside a batch. """
+    return json.loads(value) if isinstance(value, str) else value
+
+
+def parse_run_parameters(data):
+    """ Validate posted run settings into the parameters stored on a model run. """
+
+    total_active_cells = int(data['total_active_cells'])
+    total_cells = int(data['total_cells'])
+    if total_active_cells > 100000:
+        total_active_cells = int(total_active_cells / total_cells * 100000)
+        total_cells = 100000
+
+    # clean input transition targets
+    transition_targets = decoded(data['transition_targets'])
+    clean_transition_targets = dict()
+    for veg in transition_targets:
+        veg_targets = list()
+        for action in transition_targets[veg]:
+            try:
+                veg_targets.append({
+                    action: {
+                    'iteration': '',    # no iteration or timestep control, yet
+                    'timestep': '',
+                    'amount': int(transition_targets[veg][action])
+                    }
+                })
+            except:
+                continue
+        if len(veg_targets) > 0:
+            clean_transition_targets[veg] = veg_targets
+
+    return {
+        'timesteps': int(data['timesteps']),
+        'iterations': int(data['iterations']),
+        'is_spatial': bool(decoded(data['spatial'])),
+        'stateclass_relative_distribution': decoded(data['veg_slider_values_state_class']),
+        'total_active_cells': total_active_cells,
+        'total_cells': total_cells,
+        'probabilistic_transitions_modifiers': decoded(data['probabilistic_transitions_slider_values']),
+        'transition_targets': clean_transition_targets
+    }
+
+
 class RunModelView(STSimBaseView):
 
     def __init__(self):
@@ -404,117 +377,34 @@ class RunModelView(STSimBaseView):
 
     def post(self, request, *args, **kwargs):
 
-        timesteps = int(request.POST['timesteps'])
-        step = 1
-        min_step = 0
-        max_step = timesteps
-        iterations = int(request.POST['iterations'])
-        is_spatial = json.loads(request.POST['spatial'])
-        stateclass_relative_distribution = json.loads(request.POST['veg_slider_values_state_class'])
-        total_active_cells = int(request.POST['total_active_cells'])
-        total_cells = int(request.POST['total_cells'])
-        if total_active_cells > 100000:
-            total_active_cells = int(total_active_cells / total_cells * 100000)
-            total_cells = 100000
-        probabilistic_transitions_modifiers = json.loads(request.POST['probabilistic_transitions_slider_values'])
-        transition_targets = json.loads(request.POST['transition_targets'])
-
-        # working file path
-        init_conditions_file = os.path.join(settings.STSIM_WORKING_DIR,
-                                            "initial_conditions",
-                                            "user_defined_temp" + str(time.time()) + ".csv")
-
-        # set the run control for the spatial model
-        self.stsim.update_run_control(
-            sid=self.scenario_id, working_path=init_conditions_file,
-            spatial=is_spatial, iterations=iterations, start_timestep=min_step, end_timestep=max_step
-        )
-
-        output_settings = {
-            'SummaryOutputSC': True,
-            'SummaryOutputSCTimesteps': step,
-            'SummaryOutputTR': True,
-            'SummaryOutputTRTimesteps': step
-        }
-
-        if is_spatial:
-
-            if not settings.DEBUG:
-                return HttpResponseNotFound()   # Prevent spatial runs for now.
-
-            output_settings['RasterOutputSC'] = True
-            output_settings['RasterOutputSCTimesteps'] = step
-
-            if not stsim_manager.has_predefined_extent[self.library]:
-
-                veg_path = os.path.join(self.output_path, self.raster_uuid + '-veg.tif')
-                sc_path = os.path.join(self.output_path, self.raster_uuid + '-sc.tif')
-
-                # check if a conversion to the stateclasses needs to happen before running stsim
-                if stsim_manager.has_lookup_fields[self.library]:
-                    sc_path = os.path.join(self.output_path, self.raster_uuid + '-' +
-                                           stsim_manager.conversion_extensions[self.library] + '.tif')
-                # import vegtype, stateclass raster into stsim
-                self.stsim.import_spatial_initial_conditions(sid=self.scenario_id, working_path=init_conditions_file,
-                                                         strata_path=veg_path, sc_path=sc_path)
-        else:
-            self.stsim.import_nonspatial_conditions(
-                self.scenario_id,
-                {'TotalAmount': str(cells_to_acres(total_active_cells,
-                                    stsim_manager.resolutions[self.library])),
-                 'NumCells': str(total_active_cells),
-                 'CalcFromDist': ''},   # Distribution seems off, since we would need to set the number of acres per vegtype.
-                 init_conditions_file)
-            self.stsim.import_nonspatial_distribution(self.scenario_id,
-                                                      stateclass_relative_distribution,
-                                                      init_conditions_file)
-
-        # update the output options for the step size
-        self.stsim.set_output_options(self.scenario_id, init_conditions_file, **output_settings)
-
-        # probabilistic transition probabilities
-        probabilities = self.stsim.export_probabilistic_transitions_map(self.scenario_id, init_conditions_file, orig=True)
-
-        # if the values are modified by the user, adjust them and pass them to ST-Sim working library
-        if probabilistic_transitions_modifiers is not None and len(probabilistic_transitions_modifiers.keys()) > 0:
-            for veg_type in probabilities.keys():
-                for state_class in probabilities[veg_type]:
-                    transition_type = state_class['type']
-                    if transition_type in probabilistic_transitions_modifiers.keys():
-                        value = probabilistic_transitions_modifiers[transition_type]
-                        state_class['probability'] += value
-
-        self.stsim.import_probabilistic_transitions(self.scenario_id,
-                                                    probabilities,
-                                                    init_conditions_file)
-
-        # clean input and import transition targets
-        clean_transition_targets = dict()
-        for veg in transition_targets:
-            veg_targets = list()
-            for action in transition_targets[veg]:
-                try:
-                    value = int(transition_targets[veg][action])
-                    veg_targets.append({
-                        action: {
-                        'iteration': '',    # no iteration or timestep control, yet
-                        'timestep': '',
-                        'amount': int(transition_targets[veg][action])
-                        }
-                    })
-                except:
-                    continue
-            if len(veg_targets) > 0:
-                clean_transition_targets[veg] = veg_targets
-
-        if len(clean_transition_targets.keys()) > 0:
-            self.stsim.import_transition_targets(self.scenario_id,
-                                                 init_conditions_file,
-                                                 clean_transition_targets)
-
-        model_run = STSimModelRun.objects.create(scenario_id=int(self.scenario_id))
+        try:
+            parameters = parse_run_parameters(request.POST)
+        except (KeyError, ValueError, TypeError):
+            return HttpResponseBadRequest()
+
+        error = self.check_extent(parameters)
+        if error is not None:
+            return error
+
+        # identical settings on an unchanged library give identical results, so hand back the earlier run
+        run_hash = result_cache.parameters_hash(self.library, self.scenario_id, self.raster_uuid, parameters)
+        cached_run = result_cache.cached_run(self.library, run_hash)
+        if cached_run is not None:
+            return HttpResponse(json.dumps({'model_run_id': cached_run.pk, 'status': 'complete',
+                                            'result_scenario_id': cached_run.result_scenario_id,
+                                            'total_active_cells': parameters['total_active_cells'],
+                                            'total_cells': parameters['total_cells']}))
+
+        if not scheduling.admit(self.library):
+            return too_busy()
+
+        # the inputs are written into a working copy of the library and the model is run by the task queue
+        model_run = STSimModelRun.objects.create(scenario_id=int(self.scenario_id), raster_uuid=self.raster_uuid,
+                                                 library=self.library, parameters=json.dumps(parameters),
+                                                 parameters_hash=run_hash, **STSimModelRun.size_fields(parameters))
         model_run_id = model_run.pk
-        run_stsim.delay(self.library, model_run_id, self.scenario_id)  # start model run
+        start_model_run(model_run_id)  # start model run
+        result_cache.evict(self.library)
 
         # run stsim model at self.scenario_id and return the result scenario id
 
@@ -539,8 +429,104 @@ class RunModelView(STSimBaseView):
         #results_json = json.dumps(self.stsim.export_stateclass_summary(result_scenario_id, report_file, norm=norm))
         #return HttpResponse(json.dumps({'results_json': results_json, 'result_scenario_id': result_scenario_id}))
 
+        total_active_cells = parameters['total_active_cells']
+        total_cells = parameters['total_cells']
         return HttpResponse(json.dumps({'model_run_id': model_run_id, 'status': 'started', 'total_active_cells': total_active_cells, 'total_cells': total_cells}))
 
+    def check_extent(self, parameters):
+        """ An error response if the run can't be done on the selected extent, otherwise None. """
+        if parameters['is_spatial']:
+
+            if not settings.DEBUG:
+                return HttpResponseNotFound()   # Prevent spatial runs for now.
+
+            if not stsim_manager.has_predefined_extent[self.library] \
+                    and selections.load_selection(self.library, self.raster_uuid) is None:
+                return HttpResponseNotFound()
+        return None
+
+
+class RunBatchView(RunModelView):
+    """
+    Runs a list of parameter sets on the same extent as one batch, e.g. to sweep a slider.
+    The members run in parallel across the workers, and the batch collects their results once all of them are done.
+    """
+
+    max_runs = getattr(settings, 'STSIM_BATCH_MAX_RUNS', 100)
+
+    def post(self, request, *args, **kwargs):
+
+        try:
+            parameter_sets = [parse_run_parameters(data) for data in json.loads(request.POST['parameter_sets'])]
+        except (KeyError, ValueError, TypeError):
+            return HttpResponseBadRequest()
+        if len(parameter_sets) == 0 or len(parameter_sets) > self.max_runs:
+            return HttpResponseBadRequest()
+
+        for parameters in parameter_sets:
+            error = self.check_extent(parameters)
+            if error is not None:
+                return error
+
+        if not scheduling.admit(self.library, runs=len(parameter_sets)):
+            return too_busy()
+
+        batch = STSimModelRun.objects.create(scenario_id=int(self.scenario_id), raster_uuid=self.raster_uuid,
+                                             library=self.library)
+
+        # members with the same settings as an earlier run take its results instead of running again
+        pending = list()
+        for parameters in parameter_sets:
+            run_hash = result_cache.parameters_hash(self.library, self.scenario_id, self.raster_uuid, parameters)
+            cached_run = result_cache.cached_run(self.library, run_hash)
+            model_run = STSimModelRun.objects.create(scenario_id=int(self.scenario_id), raster_uuid=self.raster_uuid,
+                                                     library=self.library, parameters=json.dumps(parameters),
+                                                     parameters_hash=run_hash, parent=batch,
+                                                     **STSimModelRun.size_fields(parameters))
+            if cached_run is not None:
+                # the stored results are copied, as a sharded run's can't be exported again from a working copy
+                stored_summary(cached_run)
+                model_run.results = cached_run.results
+                model_run.result_scenario_id = cached_run.result_scenario_id
+                model_run.console_slot = cached_run.console_slot
+                model_run.source_id = cached_run.source_id or cached_run.pk
+                model_run.save(update_fields=['results', 'result_scenario_id', 'console_slot', 'source'])
+            else:
+                pending.append(model_run.pk)
+
+        start_batch(batch.pk, pending)
+        result_cache.evict(self.library)
+
+        return JsonResponse({'batch_id': batch.pk, 'status': 'started', 'total': len(parameter_sets),
+                             'completed': len(parameter_sets) - len(pending)})
+
+    def get(self, request, *args, **kwargs):
+
+        try:
+            batch_id = int(request.GET['batch_id'])
+        except (KeyError, ValueError):
+            return HttpResponseBadRequest()
+        # batches are the runs without parameters of their own
+        batch = STSimModelRun.objects.filter(pk=batch_id, library=self.library, parameters='').first()
+        if batch is None:
+            return HttpResponseNotFound()
+        members = [{'model_run_id': model_run.pk, 'status': model_run.state().split(':')[0]}
+                   for model_run in batch.members.order_by('pk')]
+        response = {
+            'batch_id': batch.pk,
+            'members': members,
+            'total': len(members),
+            'completed': sum(1 for member in members if member['status'] == 'complete'),
+            'status': 'complete' if len(batch.results) > 0 else 'running'
+        }
+        if len(batch.results) > 0:
+            response['results'] = json.loads(batch.results)
+        elif all(member['status'] != 'running' for member in members):
+            # some members broke off, so the batch is never finished; it's over with the results it has
+            response['status'] = 'failed'
+            response['results'] = batch_results(batch)
+        return JsonResponse(response)
+
 
 class RunModelStatusView(STSimBaseView):
 
@@ -549,21 +535,78 @@ class RunModelStatusView(STSimBaseView):
         model_run_id = int(request.GET['model_run_id'])
         model_run = STSimModelRun.objects.get(pk=model_run_id)
         rsid = model_run.result_scenario_id
+        total_cells = int(request.GET['total_cells'])
+        total_active_cells = int(request.GET['total_active_cells'])
+        norm = total_active_cells / total_cells
         response = dict()
-        if model_run.result_scenario_id != -1:
-            report_file = os.path.join(settings.STSIM_WORKING_DIR, "model_results",
-                                       "stateclass-summary-" + str(rsid) + ".csv")
-            total_cells = int(request.GET['total_cells'])
-            total_active_cells = int(request.GET['total_active_cells'])
-            norm = total_active_cells / total_cells
-            response['results_json'] = self.stsim.export_stateclass_summary(rsid, report_file, norm=norm)
+        response['state'] = model_run.state()
+        if model_run.cancelled:
+            response['status'] = 'cancelled'
+        elif len(model_run.failure) > 0:
+            response['status'] = model_run.failure     # 'failed', 'timed_out' or 'expired'
+        elif model_run.expired():
+            response['status'] = 'expired'     # never left the queue
+        elif model_run.result_scenario_id != -1:
+            response['results_json'] = exported_summary(model_run, norm=norm)
             response['result_scenario_id'] = rsid
             response['status'] = 'complete'
         else:
             response['status'] = 'running'
+            response['progress'] = model_run.progress
+            response['current_iteration'] = model_run.current_iteration
+            response['current_timestep'] = model_run.current_timestep
+
+            # results of the timesteps done so far
+            partial = progress.partial_summary(model_run)
+            if partial is not None:
+                response['partial_results_json'] = normalize_summary(partial, norm)
         return JsonResponse(response)
 
 
+class RunModelWaitView(RunModelStatusView):
+    """
+    Long-polling version of the status view. The request is held open until the run's state differs from the
+    state the client already knows, then answers like the status view.
+    """
+
+    def get(self, request, *args, **kwargs):
+
+        model_run_id = int(request.GET['model_run_id'])
+        known_state = request.GET.get('state', 'running')
+
+        def load_state():
+            return STSimModelRun.objects.only('result_scenario_id', 'current_iteration', 'current_timestep',
+                                              'cancelled', 'failure', 'dequeued_at', 'deadline') \
+                .get(pk=model_run_id).state()
+
+        if notifications.wait_for_change(model_run_id, known_state, load_state) == known_state:
+            response = {'status': known_state.split(':')[0], 'state': known_state}
+            if not notifications.shared_state_cache():
+                response['poll_after'] = notifications.STATUS_POLL_INTERVAL     # nothing to wait on
+            return JsonResponse(response)
+        return super().get(request, *args, **kwargs)
+
+
+class CancelModelRunView(STSimBaseView):
+    """ Cancels a model run, or a whole batch, freeing the workers and working copies it holds. """
+
+    def post(self, request, *args, **kwargs):
+        model_run = STSimModelRun.objects.get(pk=int(request.POST['model_run_id']), library=self.library)
+        cancel_run(model_run)
+        return JsonResponse({'model_run_id': model_run.pk, 'status': 'cancelled'})
+
+
+class MetricsView(STSimBaseView):
+    """ Percentiles of the stage timings and sizes of recent model runs of a library. """
+
+    def get(self, request, *args, **kwargs):
+        try:
+            days = int(request.GET.get('days', 7))
+        except ValueError:
+            return HttpResponseBadRequest()
+        return JsonResponse(metrics.run_metrics(self.library, days=days))
+
+
 class RasterOutputsView(STSimBaseView):
 
     raster_types = ['veg', 'sc']
@@ -572,6 +615,7 @@ class RasterOutputsView(STSimBaseView):
         self.type = None
         self.timestep = None
         self.iteration = None
+        self.model_run_id = None
         super().__init__()
 
     def dispatch(self, request, *args, **kwargs):
@@ -580,25 +624,29 @@ class RasterOutputsView(STSimBaseView):
             raise ValueError(self.type + ' is not a valid data type. Types are ' + str(self.raster_types) + '.')
         self.timestep = int(kwargs.get('timestep'))
         self.iteration = int(kwargs.get('iteration'))
+        self.model_run_id = int(kwargs.get('model_run_id'))
         return super().dispatch(request, *args, **kwargs)
 
     def get(self, request, *args, **kwargs):
 
         if self.type == 'veg':
-            image = self.serve_vegetation_output()
+            return self.serve_vegetation_output()
         else:
-            image = self.serve_stateclass_output()
-
-        response = HttpResponse(content_type="image/png")
-        image.save(response, 'PNG')
-        return response
+            return self.serve_stateclass_output()
 
     def serve_stateclass_output(self):
-        image_directory = os.path.join(self.stsim.lib + '.output', 'Scenario-'+str(self.scenario_id), 'Spatial')
-        return Image.open(os.path.join(image_directory,
-                                       'stateclass_{iteration}_{timestep}.png'.format(iteration=self.iteration,
-                                                                                      timestep=self.timestep)))
+        # result scenario ids are numbered per working copy, so the outputs are found through the run itself
+        model_run = STSimModelRun.objects.filter(pk=self.model_run_id, library=self.library) \
+            .exclude(result_scenario_id=-1).first()
+        if model_run is None:
+            return HttpResponseNotFound()
+        return png_file_response(os.path.join(model_run.output_directory(),
+                                              'stateclass_{iteration}_{timestep}.png'.format(
+                                                  iteration=self.iteration, timestep=self.timestep)))
 
     def serve_vegetation_output(self):
         # TODO - serve veg/strata output raster
-        return Image.new('L', (64, 64))
+        image = Image.new('L', (64, 64))
+        response = HttpResponse(content_type="image/png")
+        image.save(response, 'PNG')
+        return response
@@ -1,5 +1,6 @@
 import os
 from celery import Celery
+from kombu import Exchange, Queue
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'Sagebrush.settings')
 
@@ -7,6 +8,16 @@ app = Celery('Sagebrush')
 
 app.config_from_object('django.conf:settings', namespace='CELERY')
 
+
+def default_queues():
+    """ Workers started without -Q consume both the interactive and the batch queue of the model runs. """
+    from django.conf import settings
+    names = (getattr(settings, 'STSIM_INTERACTIVE_QUEUE', 'celery'),
+             getattr(settings, 'STSIM_BATCH_QUEUE', 'stsim_batch'))
+    return {'task_queues': tuple(Queue(name, Exchange(name), routing_key=name) for name in names)}
+
+app.add_defaults(default_queues)
+
 app.autodiscover_tasks()
 
 @app.task(bind=True)
@@ -0,0 +1,174 @@
+"""
+    Read-only, direct SQL access to ST-Sim libraries.
+
+    A SyncroSim library is a SQLite database, so the definitions, transitions and
+    summary output we consume can be read straight from its tables instead of
+    exporting them through the console. Results are shaped exactly like the
+    stsimpy exports (csv rows, so every value is a string) so callers can use
+    either interchangeably, and any sqlite3.Error lets the caller fall back to
+    the console.
+"""
+
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from urllib.request import pathname2url
+
+
+class ReadOnlyLibrary:
+    """
+        Pool of read-only connections to a library, one per thread.
+    """
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.local = threading.local()
+
+    def connection(self):
+        """ The calling thread's connection, opened on first use. """
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            if not os.path.exists(self.path):
+                raise sqlite3.OperationalError('unable to open database file: ' + self.path)
+            connection = sqlite3.connect('file:{}?mode=ro'.format(pathname2url(self.path)), uri=True)
+            connection.row_factory = sqlite3.Row
+            self.local.connection = connection
+        return connection
+
+    def query(self, sql, params=()):
+        return self.connection().execute(sql, params).fetchall()
+
+    def close(self):
+        """ Close the calling thread's connection, e.g. before the thread exits. """
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self.local.connection = None
+
+
+_libraries = dict()
+_libraries_lock = threading.Lock()
+
+
+def library(path, generation=None):
+    """
+    The shared connection pool for a library file.
+    :param path: Path to the library
+    :param generation: Changes whenever the file is replaced by a new copy, dropping the connections to the old one
+    """
+    path = os.path.abspath(path)
+    with _libraries_lock:
+        if path not in _libraries or _libraries[path][0] != generation:
+            _libraries[path] = (generation, ReadOnlyLibrary(path))
+        return _libraries[path][1]
+
+
+def _text(value):
+    return '' if value is None else str(value)
+
+
+def _definitions(db, table, key_column, pid):
+    """
+    Project definitions keyed by name, with the same columns the console exports.
+    :param db: A ReadOnlyLibrary
+    :param table: Definitions table, e.g. STSim_StateClass
+    :param key_column: The table's internal key, which the console leaves out
+    :param pid: The project id
+    """
+    rows = db.query('SELECT * FROM {} WHERE ProjectID = ? ORDER BY Name'.format(table), (pid,))
+    definitions = OrderedDict()
+    for row in rows:
+        definitions[row['Name']] = {column: _text(row[column]) for column in row.keys()
+                                    if column not in ('Name', 'ProjectID', key_column)}
+    return definitions
+
+
+def vegtype_definitions(db, pid):
+    return _definitions(db, 'STSim_Stratum', 'StratumID', pid)
+
+
+def stateclass_definitions(db, pid):
+    return _definitions(db, 'STSim_StateClass', 'StateClassID', pid)
+
+
+def veg_state_classes(db, sid):
+    """ The state classes available to each vegetation type, from the deterministic transitions. """
+    rows = db.query(
+        'SELECT DISTINCT s.Name AS veg, c.Name AS sc '
+        'FROM STSim_DeterministicTransition d '
+        'JOIN STSim_Stratum s ON s.StratumID = d.StratumIDSource '
+        'JOIN STSim_StateClass c ON c.StateClassID = d.StateClassIDSource '
+        'WHERE d.ScenarioID = ? ORDER BY s.Name, c.Name', (sid,))
+    veg_state_classes = OrderedDict()
+    for row in rows:
+        veg_state_classes.setdefault(row['veg'], list()).append(row['sc'])
+    return veg_state_classes
+
+
+def probabilistic_transition_types(db, sid):
+    """ The transition types used by the probabilistic transitions of a scenario. """
+    rows = db.query(
+        'SELECT DISTINCT t.Name AS name FROM STSim_Transition p '
+        'JOIN STSim_TransitionType t ON t.TransitionTypeID = p.TransitionTypeID '
+        'WHERE p.ScenarioID = ? ORDER BY t.Name', (sid,))
+    return [row['name'] for row in rows]
+
+
+def transition_groups(db, pid):
+    """ The transition groups defined in a project. """
+    rows = db.query('SELECT Name AS name FROM STSim_TransitionGroup WHERE ProjectID = ? ORDER BY Name', (pid,))
+    return [row['name'] for row in rows]
+
+
+def stateclass_summary(db, result_sid, norm=1.0):
+    """
+    Stateclass summary output of a result scenario, as {iteration: {timestep: {veg: {sc: fraction}}}}.
+    Amounts are summed over age classes and divided by the total amount at each iteration and timestep.
+    :param db: A ReadOnlyLibrary
+    :param result_sid: The result scenario id
+    :param norm: Multiplier applied to each fraction
+    """
+    rows = db.query(
+        'SELECT o.Iteration AS iteration, o.Timestep AS timestep, s.Name AS veg, c.Name AS sc, '
+        'SUM(o.Amount) AS amount '
+        'FROM STSim_OutputStratumState o '
+        'JOIN STSim_Stratum s ON s.StratumID = o.StratumID '
+        'JOIN STSim_StateClass c ON c.StateClassID = o.StateClassID '
+        'WHERE o.ScenarioID = ? '
+        'GROUP BY o.Iteration, o.Timestep, s.Name, c.Name '
+        'ORDER BY o.Iteration, o.Timestep', (result_sid,))
+
+    totals = dict()
+    for row in rows:
+        key = (row['iteration'], row['timestep'])
+        totals[key] = totals.get(key, 0) + row['amount']
+
+    summary = OrderedDict()
+    for row in rows:
+        total = totals[(row['iteration'], row['timestep'])]
+        iteration = summary.setdefault(str(row['iteration']), OrderedDict())
+        timestep = iteration.setdefault(str(row['timestep']), OrderedDict())
+        timestep.setdefault(row['veg'], OrderedDict())[row['sc']] = row['amount'] / total * norm if total else 0
+    return summary
+
+
+def latest_output_scenario(db):
+    """ The most recent scenario with stateclass summary output, 0 if there is none. """
+    rows = db.query('SELECT MAX(ScenarioID) AS sid FROM STSim_OutputStratumState')
+    return rows[0]['sid'] or 0
+
+
+def output_progress(db, after_sid):
+    """
+    How far the run writing the newest scenario after after_sid has come.
+    :return: (scenario id, latest iteration, latest timestep, number of iteration timesteps written), or None
+    """
+    rows = db.query(
+        'SELECT ScenarioID AS sid, MAX(Iteration) AS iteration, MAX(Timestep) AS timestep, '
+        'COUNT(DISTINCT Iteration * 1000000 + Timestep) AS steps '
+        'FROM STSim_OutputStratumState WHERE ScenarioID > ? '
+        'GROUP BY ScenarioID ORDER BY ScenarioID DESC LIMIT 1', (after_sid,))
+    if len(rows) == 0:
+        return None
+    return rows[0]['sid'], rows[0]['iteration'], rows[0]['timestep'], rows[0]['steps']
@@ -4,30 +4,371 @@
 
 from stsimpy import STSimConsole
 import os
+import json
+import errno
+import shutil
+import signal
+import sqlite3
+import time
+import uuid
+import logging
+import threading
+import numpy as np
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from json import loads
 from django.conf import settings
+from Sagebrush import stsim_sql
+
+logger = logging.getLogger(__name__)
+
+# Bump whenever the structure of the library metadata changes, to discard old snapshots
+SNAPSHOT_VERSION = 1
+
+# Number of working copies of each library, i.e. how many models of a library can run at once
+CONSOLE_POOL_SIZE = getattr(settings, 'STSIM_CONSOLE_POOL_SIZE', 1)
+
+# Per-library overrides of the pool size, capping how many runs of a library take up workers at once
+CONSOLE_POOL_SIZES = getattr(settings, 'STSIM_CONSOLE_POOL_SIZES', dict())
+
+# Replace a working copy with a fresh one after this many runs, 0 to keep them forever
+CONSOLE_RECYCLE_RUNS = getattr(settings, 'STSIM_CONSOLE_RECYCLE_RUNS', 0)
+
+# Seconds after which a lease that wasn't renewed is considered abandoned, e.g. by a worker that died mid-run.
+# Leases are renewed while a task works on the run, so this only has to outlast the wait between its tasks.
+CONSOLE_LEASE_TIMEOUT = getattr(settings, 'STSIM_CONSOLE_LEASE_TIMEOUT', 6 * 3600)
+
+# Seconds to wait for a free working copy before turning a run request down
+CONSOLE_ACQUIRE_TIMEOUT = getattr(settings, 'STSIM_CONSOLE_ACQUIRE_TIMEOUT', 30)
+
+
+@contextmanager
+def log_duration(phase, lib_name=None):
+    """ Log how long a phase of the startup took. """
+    start = time.time()
+    yield
+    logger.info('%s%s took %.2fs', phase, ' for ' + lib_name if lib_name else '', time.time() - start)
+
+
+class LibraryMap(Mapping):
+    """
+        Read-only mapping of library names to values that are only loaded when first looked up.
+    """
+
+    def __init__(self, library_names, load):
+        self.library_names = library_names
+        self.load = load
+
+    def __getitem__(self, lib_name):
+        if lib_name not in self.library_names:
+            raise KeyError(lib_name)
+        return self.load(lib_name)
+
+    def __contains__(self, lib_name):
+        return lib_name in self.library_names
+
+    def __iter__(self):
+        return iter(self.library_names)
+
+    def __len__(self):
+        return len(self.library_names)
+
+
+class TransitionTable:
+    """
+        A probabilistic transition map flattened into arrays, so slider modifiers are applied in one step.
+    """
+
+    def __init__(self, transitions):
+        self.transitions = transitions
+        self.rows = [(veg, transition) for veg in transitions for transition in transitions[veg]]
+        self.types, self.type_index = np.unique(np.array([transition['type'] for veg, transition in self.rows],
+                                                         dtype=str),
+                                                return_inverse=True)
+        self.probabilities = np.array([transition['probability'] for veg, transition in self.rows], dtype=float)
+
+    def modified(self, modifiers=None):
+        """
+        The transition map with the modifier of each transition type added to its probabilities.
+        :param modifiers: {transition type: value added to the probability}
+        """
+        probabilities = self.probabilities
+        if modifiers is not None and len(modifiers.keys()) > 0:
+            deltas = np.array([modifiers.get(transition_type, 0) for transition_type in self.types], dtype=float)
+            probabilities = probabilities + deltas[self.type_index]
+
+        transitions = {veg: list() for veg in self.transitions}
+        for (veg, transition), probability in zip(self.rows, probabilities.tolist()):
+            transitions[veg].append(dict(transition, probability=probability))
+        return transitions
+
+
+def console_processes():
+    """ Ids of the processes this process started, i.e. its running consoles. Needs /proc, so empty elsewhere. """
+    pids = set()
+    if not os.path.isdir('/proc'):
+        return pids
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open(os.path.join('/proc', name, 'stat'), 'r') as f:
+                fields = f.read().rsplit(')', 1)[1].split()     # the command name may hold spaces
+        except (OSError, IndexError):
+            continue
+        if int(fields[1]) == os.getpid() and fields[0] != 'Z':
+            pids.add(int(name))
+    return pids
+
+
+def stop_console_processes(grace=10.0, reap=False):
+    """
+    Stop the consoles this process started, e.g. when their run was cancelled or ran out of time.
+    :param grace: Seconds the consoles get to exit after being asked to, before they are killed
+    :param reap: Wait for the consoles to exit here, when their run no longer waits on them itself
+    :return: Ids of the processes that were stopped
+    """
+    stopped = console_processes()
+    for pid in stopped:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    deadline = time.time() + grace
+    while time.time() < deadline and len(console_processes() & stopped) > 0:
+        if reap:
+            for pid in stopped:
+                try:
+                    os.waitpid(pid, os.WNOHANG)
+                except ChildProcessError:
+                    pass
+        time.sleep(0.1)
+    for pid in console_processes() & stopped:
+        logger.warning('Killing console process %d', pid)
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+    if reap:
+        for pid in stopped:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+    return stopped
+
+
+class ConsolePool:
+    """
+        Working copies of a library, each with its own console, checked out for one model run at a time.
+
+        Leases are files created exclusively in a directory shared by the web and celery processes,
+        so a slot is never handed to two runs at once, whichever process asks for it. Each lease
+        holds a token, so only the run that took a lease can renew or release it.
+    """
+
+    def __init__(self, lib_name, orig_path, lib_path, exe, size=1, recycle_runs=0, lease_timeout=6 * 3600):
+        self.lib_name = lib_name
+        self.orig_path = orig_path
+        self.lib_path = lib_path
+        self.exe = exe
+        self.size = max(1, size)
+        self.recycle_runs = recycle_runs
+        self.lease_timeout = lease_timeout
+        self.lease_dir = os.path.join(settings.STSIM_WORKING_DIR, 'console_pool', lib_name)
+        self.lock = threading.RLock()
+        self.consoles = dict()
+
+    def slot_path(self, slot):
+        """ The working copy of a slot. Slot 0 is the library's usual working copy. """
+        if slot == 0:
+            return self.lib_path
+        base, ext = os.path.splitext(self.lib_path)
+        return '{}-worker{}{}'.format(base, slot, ext)
+
+    def console(self, slot=0):
+        """ The stsimpy console of a slot, created on first use or after the slot was recycled. """
+        if slot not in self.consoles or not os.path.exists(self.slot_path(slot)):
+            with self.lock:
+                if slot not in self.consoles or not os.path.exists(self.slot_path(slot)):
+                    with log_duration('Optimizing ST-Sim library for usage', self.lib_name):
+                        self.consoles[slot] = STSimConsole(orig_lib_path=self.orig_path,
+                                                           lib_path=self.slot_path(slot),
+                                                           exe=self.exe)
+        return self.consoles[slot]
+
+    def lease_path(self, slot):
+        return os.path.join(self.lease_dir, '{}.lease'.format(slot))
+
+    def runs_path(self, slot):
+        return os.path.join(self.lease_dir, '{}.runs'.format(slot))
+
+    def try_lease(self, slot):
+        """
+        Take the lease on a slot if it is free, or if its holder abandoned it.
+        :return: The token of the new lease, or None if the slot is taken
+        """
+        path = self.lease_path(slot)
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            try:
+                if time.time() - os.path.getmtime(path) < self.lease_timeout:
+                    return None
+                logger.warning('Breaking abandoned lease on slot %d of %s', slot, self.lib_name)
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            return None
+        token = uuid.uuid4().hex
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'pid': os.getpid(), 'time': time.time(), 'token': token}, f)
+        return token
+
+    def lease_token(self, slot):
+        """ The token of the current lease on a slot, None if the slot is free. """
+        try:
+            with open(self.lease_path(slot), 'r') as f:
+                return json.load(f).get('token')
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def acquire(self, timeout=None, poll_interval=1.0):
+        """
+        Check out a free slot, waiting for one if they are all in use.
+        :param timeout: Seconds to wait before giving up, or None to wait indefinitely
+        :return: (slot number, lease token)
+        """
+        os.makedirs(self.lease_dir, exist_ok=True)
+        start = time.time()
+        while True:
+            for slot in range(self.size):
+                token = self.try_lease(slot)
+                if token is not None:
+                    self.recycle_if_due(slot)
+                    return slot, token
+            if timeout is not None and time.time() - start > timeout:
+                raise TimeoutError('No free ST-Sim working copy of ' + self.lib_name)
+            time.sleep(poll_interval)
+
+    def renew(self, slot, token):
+        """ Keep a lease from being taken for abandoned. Returns False if the lease was lost. """
+        if self.lease_token(slot) != token:
+            return False
+        try:
+            os.utime(self.lease_path(slot))
+        except FileNotFoundError:
+            return False
+        return True
+
+    @contextmanager
+    def keep_lease(self, slot, token):
+        """ Renew a lease in the background for as long as the block runs, e.g. while a model runs. """
+        stopped = threading.Event()
+        interval = min(60.0, self.lease_timeout / 4.0)
+
+        def renew():
+            while not stopped.wait(interval):
+                if not self.renew(slot, token):
+                    logger.warning('Lost the lease on slot %d of %s', slot, self.lib_name)
+                    return
+
+        renewer = threading.Thread(target=renew, daemon=True)
+        renewer.start()
+        try:
+            yield
+        finally:
+            stopped.set()
+            renewer.join()
+
+    def release(self, slot, token):
+        """
+        Return a slot to the pool, counting the run it was used for. Only the holder of the lease can release it,
+        so a run that lost its lease never frees the slot from under the run that took it over.
+        :return: Whether the lease was released
+        """
+        if self.lease_token(slot) != token:
+            logger.warning('Not releasing slot %d of %s, its lease is held by another run', slot, self.lib_name)
+            return False
+        self.set_runs(slot, self.runs(slot) + 1)
+        try:
+            os.remove(self.lease_path(slot))
+        except FileNotFoundError:
+            pass
+        return True
+
+    def runs(self, slot):
+        try:
+            with open(self.runs_path(slot), 'r') as f:
+                return int(f.read() or 0)
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def set_runs(self, slot, runs):
+        with open(self.runs_path(slot), 'w') as f:
+            f.write(str(runs))
+
+    def library(self, slot):
+        """ Read-only SQL access to the working copy of a slot, reconnected once the copy was recycled. """
+        return stsim_sql.library(self.slot_path(slot), generation=self.recycled_at(slot))
+
+    def recycled_at(self, slot):
+        """ When the working copy of a slot was last replaced, 0 if it never was. """
+        try:
+            return os.path.getmtime(os.path.join(self.lease_dir, '{}.recycled'.format(slot)))
+        except FileNotFoundError:
+            return 0
+
+    def recycle_if_due(self, slot):
+        """
+        Replace the working copy of a leased slot with a fresh copy once it served enough runs.
+        Completed runs moved their spatial outputs out of the slot, so the whole output directory goes with it.
+        """
+        if self.recycle_runs <= 0 or self.runs(slot) < self.recycle_runs:
+            return
+        with self.lock:
+            logger.info('Recycling slot %d of %s after %d runs', slot, self.lib_name, self.runs(slot))
+            self.consoles.pop(slot, None)
+            path = self.slot_path(slot)
+            if os.path.exists(path):
+                os.remove(path)
+            shutil.rmtree(path + '.output', ignore_errors=True)
+            self.set_runs(slot, 0)
+            with open(os.path.join(self.lease_dir, '{}.recycled'.format(slot)), 'w'):
+                pass
 
 
 class STSimManager:
     """
         In-memory management of STSimConsole instances.
+
+        Consoles and the metadata exported from each library are loaded per library on first use.
+        The metadata is kept in a snapshot next to this file, keyed by the library file's size and
+        modification time, so a warm start doesn't need the console at all.
     """
 
     def __init__(self, config_path, exe):
-        with open(config_path, 'r') as f:
-            config = loads(f.read())
+        with log_duration('Reading the ST-Sim configuration'):
+            with open(config_path, 'r') as f:
+                config = loads(f.read())
         self.config = config
-        print('Optimizing ST-Sim libraries for usage...')
-        init_path = os.path.join(os.path.dirname(os.path.abspath(__file__)))
+        self.exe = exe
+        self.init_path = os.path.join(os.path.dirname(os.path.abspath(__file__)))
         self.library_names = list(config.keys())
+        self.locks = {lib_name: threading.RLock() for lib_name in self.library_names}
 
-        # stsimpy console
-        self.consoles = {
-            lib_name: STSimConsole(orig_lib_path=config[lib_name]['orig_path'],
-                                   lib_path=config[lib_name]['lib_path'],
-                                   exe=exe)
+        # stsimpy consoles, one pool of working copies per library
+        self.console_pools = {
+            lib_name: ConsolePool(lib_name, config[lib_name]['orig_path'], config[lib_name]['lib_path'], exe,
+                                  size=CONSOLE_POOL_SIZES.get(lib_name, CONSOLE_POOL_SIZE),
+                                  recycle_runs=CONSOLE_RECYCLE_RUNS,
+                                  lease_timeout=CONSOLE_LEASE_TIMEOUT)
             for lib_name in self.library_names
         }
+        self.consoles = LibraryMap(self.library_names, self.console)
 
         # Specified pids, sids, and various transition types that we want to expose to the user interface
         self.pids = {lib_name: config[lib_name]['pid'] for lib_name in self.library_names}
@@ -58,6 +399,13 @@ class STSimManager:
         self.conversion_functions = {lib_name: config[lib_name]['conversion_function'] for lib_name in self.library_names}
         self.conversion_extensions = {lib_name: config[lib_name]['conversion_extension'] for lib_name in self.library_names}
 
+        # where the library-wide converted stateclass raster lives, once it has been built
+        self.converted_sc_paths = {
+            lib_name: os.path.splitext(self.sc_paths[lib_name])[0] + '-' + self.conversion_extensions[lib_name] + '.tif'
+            if len(self.conversion_functions[lib_name]) > 0 else None
+            for lib_name in self.library_names
+        }
+
         # pre-defined extent information and how to get the heightmap
         self.has_predefined_extent = {lib_name: config[lib_name]['has_predefined_extent'] for lib_name in self.library_names}
         self.heightmap_functions = {lib_name: config[lib_name]['heightmap_function'] for lib_name in self.library_names}
@@ -67,76 +415,250 @@ class STSimManager:
         self.tile_directory = {lib_name: config[lib_name]['tile_directory'] for lib_name in self.library_names}
         self.reporting_units = {lib_name: config[lib_name]['reporting_units'] for lib_name in self.library_names}
 
-        # validation b/w configuration and library information
-        self.all_veg_state_classes = {
-            lib_name: self.consoles[lib_name].export_veg_state_classes(
-                sid=self.sids[lib_name],
-                readonly=os.path.exists(os.path.join(init_path, lib_name + '-vegsc.csv')),
-                state_class_path=os.path.join(init_path, lib_name + '-vegsc.csv'))
-            for lib_name in self.library_names
-        }
+        # library metadata exported through the console, loaded per library on first use
+        self._metadata = dict()
 
-        self.all_probabilistic_transition_types = {
-            lib_name: self.consoles[lib_name].export_probabilistic_transitions_types(
-                sid=self.sids[lib_name],
-                readonly=os.path.exists(os.path.join(init_path, lib_name + '-tr.csv')),
-                transitions_path=os.path.join(init_path, lib_name + '-tr.csv')
-            )
-            for lib_name in self.library_names
-        }
+        # original probabilistic transitions by (library, scenario), with the library stamp they were exported at
+        self._transitions = dict()
+        for name in ['all_veg_state_classes', 'all_probabilistic_transition_types',
+                     'all_probabilistic_transition_groups', 'transition_groups_by_veg',
+                     'vegtype_definitions', 'stateclass_definitions']:
+            setattr(self, name, LibraryMap(self.library_names,
+                                           lambda lib_name, name=name: self.metadata(lib_name)[name]))
 
-        for library in self.library_names:
-            if not all(value in self.all_probabilistic_transition_types[library]
-                       for value in self.probabilistic_transition_types[library]):
-                raise KeyError("Invalid transition type specified in configuration for this library. "
-                               "Check configuration.")
-
-        self.all_probabilistic_transition_groups = {
-            lib_name: self.consoles[lib_name].export_transition_group_types(
-                pid=self.pids[lib_name],
-                readonly=os.path.exists(os.path.join(init_path, lib_name + '-trg.csv')),
-                working_path=os.path.join(init_path, lib_name + '-trg.csv'))
-            for lib_name in self.library_names
-        }
+        if getattr(settings, 'STSIM_PRELOAD_LIBRARIES', False):
+            self.preload()
+
+    def console(self, lib_name, slot=0):
+        """ The stsimpy console of a library's working copy, created on first use. """
+        return self.console_pools[lib_name].console(slot)
+
+    def preload(self):
+        """ Load the metadata of every library, in parallel across libraries. """
+        with log_duration('Loading all ST-Sim libraries'):
+            with ThreadPoolExecutor(max_workers=max(1, len(self.library_names))) as executor:
+                for result in executor.map(self.metadata, self.library_names):
+                    pass    # surface any configuration errors
+
+    def metadata(self, lib_name):
+        """
+        Metadata of a library, from its snapshot if it is still current, otherwise exported from the console.
+        :param lib_name: Name of the library in the STSIM_CONFIG
+        """
+        if lib_name not in self._metadata:
+            with self.locks[lib_name]:
+                if lib_name not in self._metadata:
+                    key = self.snapshot_key(lib_name)
+                    snapshot = self.load_snapshot(lib_name)
+                    if snapshot is not None and snapshot['key'] == key:
+                        metadata = snapshot['metadata']
+                    else:
+                        # a stale snapshot means the library changed, so don't trust the exported csvs either
+                        metadata = self.export_metadata(lib_name, refresh=snapshot is not None)
+                        self.save_snapshot(lib_name, {'key': key, 'metadata': metadata})
+                    self.validate_metadata(lib_name, metadata)
+                    self._metadata[lib_name] = metadata
+        return self._metadata[lib_name]
+
+    def snapshot_path(self, lib_name):
+        return os.path.join(self.init_path, lib_name + '-metadata.json')
+
+    def library_stamp(self, lib_name):
+        """ Size and modification time of the original library, which changes whenever the library does. """
+        stat = os.stat(self.config[lib_name]['orig_path'])
+        return [stat.st_size, stat.st_mtime]
+
+    def snapshot_key(self, lib_name):
+        """ What the metadata of a library depends on. """
+        return json.loads(json.dumps({
+            'version': SNAPSHOT_VERSION,
+            'library': self.library_stamp(lib_name),
+            'pid': self.pids[lib_name],
+            'sid': self.sids[lib_name],
+            'transition_groups': self.probabilistic_transition_groups[lib_name]
+        }))
+
+    def load_snapshot(self, lib_name):
+        path = self.snapshot_path(lib_name)
+        if not os.path.exists(path):
+            return None
+        with log_duration('Reading the metadata snapshot', lib_name):
+            try:
+                with open(path, 'r') as f:
+                    return json.load(f)
+            except ValueError:
+                return None
+
+    def save_snapshot(self, lib_name, snapshot):
+        path = self.snapshot_path(lib_name)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(path + '.tmp', path)
+
+    def export_metadata(self, lib_name, refresh=False):
+        """
+        Export the metadata of a library, directly from the library where possible, otherwise through the console.
+        :param lib_name: Name of the library in the STSIM_CONFIG
+        :param refresh: Re-export csvs left over from earlier exports instead of reading them.
+        """
+        init_path = self.init_path
+        pid = self.pids[lib_name]
+        sid = self.sids[lib_name]
 
-        for library in self.library_names:
-            if not all(value in self.all_probabilistic_transition_groups[library]
-                       for value in self.probabilistic_transition_groups[library]):
-                raise KeyError("Invalid transition group specified in configuration for this library. "
-                               "Check configuration.")
+        def readonly(file_name):
+            return not refresh and os.path.exists(os.path.join(init_path, file_name))
+
+        db = stsim_sql.library(self.config[lib_name]['orig_path'])
+
+        def export(name, query, console_export):
+            """ Read from the library directly, or through the console if the tables can't be read. """
+            with log_duration('Exporting ' + name.replace('_', ' '), lib_name):
+                try:
+                    metadata[name] = query()
+                except sqlite3.Error as e:
+                    logger.warning('Falling back to the console for %s of %s: %s', name, lib_name, e)
+                    metadata[name] = None
+                if not metadata[name]:
+                    metadata[name] = console_export()
+
+        metadata = dict()
+        export('all_veg_state_classes',
+               lambda: stsim_sql.veg_state_classes(db, sid),
+               lambda: self.console(lib_name).export_veg_state_classes(
+                   sid=sid,
+                   readonly=readonly(lib_name + '-vegsc.csv'),
+                   state_class_path=os.path.join(init_path, lib_name + '-vegsc.csv')))
+
+        export('all_probabilistic_transition_types',
+               lambda: stsim_sql.probabilistic_transition_types(db, sid),
+               lambda: self.console(lib_name).export_probabilistic_transitions_types(
+                   sid=sid,
+                   readonly=readonly(lib_name + '-tr.csv'),
+                   transitions_path=os.path.join(init_path, lib_name + '-tr.csv')))
+
+        export('all_probabilistic_transition_groups',
+               lambda: stsim_sql.transition_groups(db, pid),
+               lambda: self.console(lib_name).export_transition_group_types(
+                   pid=pid,
+                   readonly=readonly(lib_name + '-trg.csv'),
+                   working_path=os.path.join(init_path, lib_name + '-trg.csv')))
 
         # transition target groups, available per veg
-        self.transition_groups_by_veg = {
-            lib_name: compute_groups_by_veg(self.consoles[lib_name], self.pids[lib_name],
-                                            self.sids[lib_name], os.path.join(init_path, lib_name + '-trgrps.csv'),
-                                            selected=self.probabilistic_transition_groups[lib_name])
-            for lib_name in self.library_names
-        }
+        with log_duration('Exporting transition groups by veg', lib_name):
+            metadata['transition_groups_by_veg'] = compute_groups_by_veg(
+                self.console(lib_name), pid, sid, os.path.join(init_path, lib_name + '-trgrps.csv'),
+                selected=self.probabilistic_transition_groups[lib_name], refresh=refresh)
 
-        self.vegtype_definitions = {
-            lib_name: self.consoles[lib_name].export_vegtype_definitions(
-                pid=self.pids[lib_name],
-                readonly=os.path.exists(os.path.join(init_path, lib_name + '-vegdefs.csv')),
-                working_path=os.path.join(init_path, lib_name + '-vegdefs.csv'))
-            for lib_name in self.library_names
-        }
+        export('vegtype_definitions',
+               lambda: stsim_sql.vegtype_definitions(db, pid),
+               lambda: self.console(lib_name).export_vegtype_definitions(
+                   pid=pid,
+                   readonly=readonly(lib_name + '-vegdefs.csv'),
+                   working_path=os.path.join(init_path, lib_name + '-vegdefs.csv')))
 
-        self.stateclass_definitions = {
-            lib_name: self.consoles[lib_name].export_stateclass_definitions(
-                pid=self.pids[lib_name],
-                readonly=os.path.exists(os.path.join(init_path, lib_name + '-scdefs.csv')),
-                working_path=os.path.join(init_path, lib_name + '-scdefs.csv'))
-            for lib_name in self.library_names
-        }
+        export('stateclass_definitions',
+               lambda: stsim_sql.stateclass_definitions(db, pid),
+               lambda: self.console(lib_name).export_stateclass_definitions(
+                   pid=pid,
+                   readonly=readonly(lib_name + '-scdefs.csv'),
+                   working_path=os.path.join(init_path, lib_name + '-scdefs.csv')))
+
+        # round trip through json so fresh exports look exactly like ones read from a snapshot
+        return json.loads(json.dumps(metadata))
+
+    def original_transitions(self, lib_name, scenario_id, working_path, console):
+        """
+        The original probabilistic transitions of a scenario, exported once per version of the library.
+        Exports are shared between processes through a json file in the working directory.
+        :param lib_name: Name of the library in the STSIM_CONFIG
+        :param scenario_id: The scenario id
+        :param working_path: Working file for the console export
+        :param console: Console to export through, if the transitions aren't cached
+        :return: A TransitionTable
+        """
+        key = (lib_name, int(scenario_id))
+        stamp = self.library_stamp(lib_name)
+        cached = self._transitions.get(key)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+
+        with self.locks[lib_name]:
+            path = os.path.join(settings.STSIM_WORKING_DIR, 'transitions', '{}-{}.json'.format(*key))
+            transitions = None
+            if os.path.exists(path):
+                try:
+                    with open(path, 'r') as f:
+                        exported = json.load(f)
+                    if exported['library'] == stamp:
+                        transitions = exported['transitions']
+                except (ValueError, KeyError):
+                    pass
+
+            if transitions is None:
+                with log_duration('Exporting probabilistic transitions', lib_name):
+                    transitions = console.export_probabilistic_transitions_map(scenario_id, working_path, orig=True)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path + '.tmp', 'w') as f:
+                    json.dump({'library': stamp, 'transitions': transitions}, f)
+                os.replace(path + '.tmp', path)
+
+            table = TransitionTable(transitions)
+            self._transitions[key] = (stamp, table)
+        return table
+
+    def stateclass_summary(self, lib_name, result_sid, report_file, norm=1.0, slot=0):
+        """
+        Stateclass summary output of a result scenario, read directly from the working library.
+        :param lib_name: Name of the library in the STSIM_CONFIG
+        :param result_sid: The result scenario id
+        :param report_file: Where the console writes its report, if the library can't be read directly
+        :param norm: Multiplier applied to each fraction
+        :param slot: The working copy the model ran in
+        """
+        try:
+            summary = stsim_sql.stateclass_summary(
+                self.console_pools[lib_name].library(slot), result_sid, norm)
+            if len(summary) > 0:
+                return summary
+        except sqlite3.Error as e:
+            logger.warning('Falling back to the console for the summary of %s: %s', lib_name, e)
+        if os.path.exists(report_file):
+            os.remove(report_file)
+        return self.console(lib_name, slot).export_stateclass_summary(result_sid, report_file, norm=norm)
+
+    def validate_metadata(self, lib_name, metadata):
+        """ Validation b/w configuration and library information """
+
+        if not all(value in metadata['all_probabilistic_transition_types']
+                   for value in self.probabilistic_transition_types[lib_name]):
+            raise KeyError("Invalid transition type specified in configuration for this library. "
+                           "Check configuration.")
+
+        if not all(value in metadata['all_probabilistic_transition_groups']
+                   for value in self.probabilistic_transition_groups[lib_name]):
+            raise KeyError("Invalid transition group specified in configuration for this library. "
+                           "Check configuration.")
+
+
+def normalize_summary(summary, norm):
+    """
+    Scale a stateclass summary, {iteration: {timestep: {veg: {sc: fraction}}}}, by a normalization factor.
+    :param summary: The summary, as exported with norm=1
+    :param norm: Multiplier applied to each fraction
+    """
+    return {iteration: {timestep: {veg: {sc: value * norm for sc, value in state_classes.items()}
+                                   for veg, state_classes in vegs.items()}
+                        for timestep, vegs in timesteps.items()}
+            for iteration, timesteps in summary.items()}
 
 
-def compute_groups_by_veg(console, pid, sid, path, selected=None):
+def compute_groups_by_veg(console, pid, sid, path, selected=None, refresh=False):
 
     # This is how to get transition groups by veg.
     transitions = console.export_probabilistic_transitions_map(sid, path.split('.')[0] + '-map.csv',
-                                                               readonly=os.path.exists(path.split('.')[0] + '-map.csv'))
+                                                               readonly=not refresh and os.path.exists(path.split('.')[0] + '-map.csv'))
     types_by_group = console.export_probabilistic_transitions_by_group(pid, path.split('.')[0] + '-grps.csv',
-                                                                       readonly=os.path.exists(path.split('.')[0] + '-grps.csv'))
+                                                                       readonly=not refresh and os.path.exists(path.split('.')[0] + '-grps.csv'))
     transition_types_by_veg = dict()
     for veg in transitions:
         transition_types_by_veg[veg] = list()